@@ -0,0 +1,623 @@
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import traceback
+
+import bromine
+
+# like tests.py's Endpoint, but with a simulated resolver path in between:
+# the client keeps queries in flight, each one carries a transmission up and
+# comes back with a few down; queries or answers may be lost, duplicated,
+# delayed and reordered. All randomness comes from the seed, simulated
+# figures (goodput, messages per byte, latency) are reproducible, cpu time
+# is not.
+#
+# python bench.py > before.json
+# python bench.py --baseline before.json  # exits 1 on regressions
+# python bench.py --micro  # to_address/from_address against the old ones
+# python bench.py --engines  # twisted against asyncio, for real on loopback
+# python bench.py --replay bromine.trace  # see TRACE in config.ini
+
+MATRIX = {
+    'n': (1, 3, 5),
+    'window': (5, 8),
+    'ackperiod': (2, 4),
+    '_tiny': (None, 40),
+}
+
+
+class Link:
+    # one direction of the path
+    def __init__(self, rng, loss=0.0, duplicate=0.0, latency=0.05,
+                 jitter=0.0, capacity=None):
+        self.rng = rng
+        self.loss = loss
+        self.duplicate = duplicate
+        self.latency = latency
+        self.jitter = jitter  # reorders messages sent close together
+        self.capacity = capacity  # messages per second, None is unbounded
+        self.free_at = 0.0
+
+    def arrivals(self, now):
+        # when the message shows up on the other side, if ever
+        if self.capacity is not None:
+            now = max(now, self.free_at) + 1 / self.capacity
+            self.free_at = now
+        if self.rng.random() < self.loss:
+            return []
+        copies = 2 if self.rng.random() < self.duplicate else 1
+        return [now + self.latency + self.jitter * self.rng.random()
+                for _ in range(copies)]
+
+
+class Peer:
+    # what both ends keep for the figures, next to the shared pumps
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.delivered = 0
+        self.expected = 0
+        self.chunks = []  # (end offset, written at) of what we wait for
+
+    def write(self, data, rhs):
+        self.score_board.push_data(data)
+        rhs.expected += len(data)
+        rhs.chunks.append((rhs.expected, self.simulation.now))
+
+    def deliver(self, data):
+        self.delivered += len(data)
+        while self.chunks and self.chunks[0][0] <= self.delivered:
+            at = self.chunks.pop(0)[1]
+            self.simulation.latencies.append(self.simulation.now - at)
+
+    def complete(self):
+        return self.delivered == self.expected
+
+
+class Client(Peer, bromine.ClientPump):
+    # client.py's Channel, with the simulation for a resolver
+    def __init__(self, simulation, profile):
+        Peer.__init__(self, simulation)
+        bromine.ClientPump.__init__(self, [('resolver', 53)], 'cname',
+                                    profile)
+
+    def now(self):
+        return self.simulation.now
+
+    def later(self):
+        self.simulation.schedule(self.simulation.now, 'pump')
+
+    def send_query(self, host, upstream, timeout, sent_at, poll):
+        self.simulation.send_query(host, timeout, (upstream, sent_at, poll))
+
+    def stop(self):
+        pass
+
+    def lose(self):
+        pass
+
+
+class Server(Peer, bromine.ServerPump):
+    # server.py's Channel, answering without EDNS0
+    def __init__(self, simulation, profile):
+        Peer.__init__(self, simulation)
+        bromine.ServerPump.__init__(self, 0, 'cname', profile)
+
+
+class Simulation:
+    def __init__(self, seed=0, upload=20000, download=20000, chunk=512,
+                 interval=0.1, limit=120.0, profile=bromine.PROFILE, **link):
+        self.rng = random.Random(seed)
+        random.seed(seed)  # bromine draws from the global one
+        self.up = Link(self.rng, **link)
+        self.down = Link(self.rng, **link)
+        self.upload, self.download, self.chunk = upload, download, chunk
+        self.interval = interval  # between writes of a chunk, 0 is bulk
+        self.limit = limit  # simulated seconds
+
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        self.outstanding = {}  # query id -> what send_query() got
+        self.messages = 0
+        self.writes = 0  # still to come
+        self.latencies = []
+        self.client = Client(self, profile)
+        self.server = Server(self, profile)
+
+    def schedule(self, at, kind, *args):
+        heapq.heappush(self.events, (at, next(self.seq), kind, args))
+
+    def send_query(self, address, timeout, query):
+        # the client's window and the resolver's rto decide, see ClientPump
+        qid = next(self.seq)
+        self.outstanding[qid] = query
+        self.messages += 1
+        for at in self.up.arrivals(self.now):
+            self.schedule(at, 'query', qid, address)
+        self.schedule(self.now + timeout, 'timeout', qid)
+
+    def on_pump(self):
+        self.client.pump()
+
+    def on_query(self, qid, address):
+        self.server.systems.add(address)
+        addresses = self.server.pump()
+        self.messages += 1
+        for at in self.down.arrivals(self.now):
+            self.schedule(at, 'answer', qid, addresses)
+
+    def on_answer(self, qid, addresses):
+        query = self.outstanding.pop(qid, None)
+        if query is not None:
+            upstream, sent_at, poll = query
+            self.client.received(addresses, upstream, sent_at, poll)
+            return
+        # late and duplicated answers still carry useful transmissions
+        for address in addresses:
+            self.client.systems.add(address)
+
+    def on_timeout(self, qid):
+        query = self.outstanding.pop(qid, None)
+        if query is not None:
+            upstream, sent_at, poll = query
+            self.client.failed(upstream, sent_at, True, poll)
+
+    def on_write(self, peer, rhs, size):
+        self.writes -= 1
+        peer.write(self.rng.randbytes(size), rhs)
+        if peer is self.client:
+            # like dataReceived in client.py
+            self.client.pump()
+
+    def schedule_writes(self, peer, rhs, total):
+        for i, start in enumerate(range(0, total, self.chunk)):
+            size = min(self.chunk, total - start)
+            self.schedule(i * self.interval, 'write', peer, rhs, size)
+            self.writes += 1
+
+    def done(self):
+        return (self.writes == 0 and self.client.complete()
+                and self.server.complete())
+
+    def run(self):
+        self.schedule_writes(self.client, self.server, self.upload)
+        self.schedule_writes(self.server, self.client, self.download)
+        cpu = time.process_time()
+        self.client.pump()
+        handlers = {'query': self.on_query, 'answer': self.on_answer,
+                    'timeout': self.on_timeout, 'write': self.on_write,
+                    'pump': self.on_pump}
+        while self.events and self.now < self.limit:
+            if self.done():
+                break
+            self.now, _, kind, args = heapq.heappop(self.events)
+            handlers[kind](*args)
+        cpu = time.process_time() - cpu
+
+        delivered = self.client.delivered + self.server.delivered
+        latencies = sorted(self.latencies)
+        return {
+            'complete': self.done(),
+            'seconds': self.now,
+            'goodput_up': self.server.delivered / max(self.now, 1e-9),
+            'goodput_down': self.client.delivered / max(self.now, 1e-9),
+            'messages_per_byte': self.messages / max(delivered, 1),
+            'latency_mean': sum(latencies) / max(len(latencies), 1),
+            'latency_p95': latencies[int(0.95 * (len(latencies) - 1))]
+            if latencies else None,
+            'cpu_per_message': cpu / max(self.messages, 1),
+            'messages': self.messages,
+        }
+
+
+def configure(settings):
+    # config.ini's DEFAULT with settings on top, None removes a key
+    config = dict(bromine.CONFIG, **settings)
+    for k, v in settings.items():
+        if v is None:
+            config.pop(k)
+    return bromine.TunnelProfile(config)
+
+
+def matrix():
+    keys = sorted(MATRIX)
+    for values in itertools.product(*(MATRIX[k] for k in keys)):
+        settings = dict(zip(keys, values))
+        if settings['window'] > settings['ackperiod']:
+            yield settings
+
+
+def bench(settings, **options):
+    try:
+        result = Simulation(profile=configure(settings), **options).run()
+    except AssertionError:
+        # the protocol gave up, e.g. select_classic found nothing to send
+        result = {'complete': False, 'error': traceback.format_exc(limit=-1)}
+    result['settings'] = settings
+    return result
+
+
+def key(settings):
+    return json.dumps(settings, sort_keys=True)
+
+
+def regressions(results, baseline, tolerance):
+    # simulated figures only, cpu time is too noisy to gate on
+    old = {key(r['settings']): r for r in baseline}
+    found = []
+    for r in results:
+        before = old.get(key(r['settings']))
+        if before is None:
+            continue
+        if before['complete'] and not r['complete']:
+            found.append((r['settings'], 'complete', True, False))
+        if 'error' in r or 'error' in before:
+            continue
+        for name in ('goodput_up', 'goodput_down'):
+            if r[name] < before[name] * (1 - tolerance):
+                found.append((r['settings'], name, before[name], r[name]))
+        if r['messages_per_byte'] > before['messages_per_byte'] * (1 + tolerance):
+            found.append((r['settings'], 'messages_per_byte',
+                          before['messages_per_byte'], r['messages_per_byte']))
+    return found
+
+
+def legacy_to_address(data):
+    # base64 to_address as it was before the single pass layout
+    tail = bromine.CONFIG['domain'].encode("ascii")
+
+    def insert_dots(split):
+        body = b'.'.join(
+            b64[e:(e+split)] for e in range(0, len(b64), split))
+        full_address = b'_' + body + b'.' + tail
+        if bromine.valid_dns_name(full_address):
+            return full_address
+        return None
+
+    b64 = bromine.to_b64(data)
+
+    dotted = insert_dots(bromine.SUB_NAME_MAX - 1)
+    if dotted is not None:
+        return dotted
+
+    chars = list(set(b64) - set(b"-_") - set(b''.join(bromine.CODEC_TAGS)))
+    random.shuffle(chars)
+    for c in chars:
+        as_byte = c.to_bytes(1, byteorder='little')
+        candidate = b64.replace(as_byte, b'.')
+        full_address = as_byte + candidate + b'.' + tail
+        if bromine.valid_dns_name(full_address):
+            return full_address
+
+    margin = bromine.NAME_MAX - len(b64) - len(tail) - 2
+    min_split = int(len(b64) / margin)
+    for split in range(min_split, bromine.SUB_NAME_MAX - 2):
+        dotted = insert_dots(split)
+        if dotted is not None:
+            return dotted
+
+    return None
+
+
+def legacy_from_address(address):
+    first = address[0].to_bytes(1, byteorder='little')
+    sub = address[1:-1-len(bromine.CONFIG['domain'])]
+    if first == b'_':
+        return bromine.from_b64(sub.replace(b'.', b''))
+    return bromine.from_b64(sub.replace(b'.', first))
+
+
+def micro(seed=0, count=2000, repeat=5):
+    # microseconds per call on max_size payloads, best of repeat
+    rng = random.Random(seed)
+    random.seed(seed)
+    size = bromine.max_size('base64')
+    payloads = [rng.randbytes(size) for _ in range(count)]
+    results = {}
+    for name, encode, decode in (
+            ('legacy', legacy_to_address, legacy_from_address),
+            ('current', lambda d: bromine.to_address(d, 'base64'),
+             bromine.from_address)):
+        addresses = [encode(d) for d in payloads]
+        ok = [a for a in addresses if a is not None]
+        timings = {
+            'to_address': min(timeit.repeat(
+                lambda: [encode(d) for d in payloads],
+                number=1, repeat=repeat)),
+            'from_address': min(timeit.repeat(
+                lambda: [decode(a) for a in ok], number=1, repeat=repeat)),
+        }
+        results[name] = {k: 1e6 * v / count for k, v in timings.items()}
+        results[name]['failures'] = len(addresses) - len(ok)
+    return results
+
+
+# --replay: a file from TRACE fed to Systems and Scoreboard again, as fast
+# as it goes or at the pace it was recorded (--timing). Each stream (a
+# channel id one way) is decoded again, what came in as the end that
+# recorded it did, what went out as its remote did; the data of the latter
+# is encoded again, a transmit() per transmission that went out, for a
+# lossless Systems that acks it all.
+INCOMING = (bromine.TRACE_NAME_IN, bromine.TRACE_PACKED_IN)
+OUTGOING = (bromine.TRACE_NAME_OUT, bromine.TRACE_PACKED_OUT)
+NAMES = (bromine.TRACE_NAME_IN, bromine.TRACE_NAME_OUT)
+
+
+class Stream:
+    def __init__(self, profile):
+        self.systems = bromine.Systems(profile=profile)
+        self.score_board = bromine.Scoreboard(profile=profile)
+        self.score_board.start_piggyback(bromine.FEATURE_SACK)
+        self.mirror = bromine.Systems(profile=profile)
+
+    def encode(self, data):
+        for d in data:
+            self.score_board.push_data(d)
+        self.mirror.add(self.score_board.transmit())
+        self.score_board.retire(self.mirror.last_seen_remote_mid)
+        self.mirror.commit()
+
+
+def replay(path, timing=False):
+    streams = {}  # (incoming, chid) -> Stream
+    counters = collections.Counter()
+    cpu = collections.Counter()
+    rows = 0
+    first = None
+    started = time.monotonic()
+    for at, kind, data in bromine.read_trace(path):
+        if first is None:
+            first = at
+        if timing:
+            time.sleep(max(0.0, started + at - first - time.monotonic()))
+        if kind in NAMES:
+            profile = bromine.find_profile(data)
+            if profile is None:
+                # a domain of the recording end's config.ini, not of ours
+                counters['skipped'] += 1
+                continue
+            transmission = profile.from_address(data)
+        else:
+            profile, transmission = bromine.PROFILE, data
+        key = (kind in INCOMING, bromine.get_channel_id(transmission))
+        stream = streams.get(key)
+        if stream is None:
+            stream = streams[key] = Stream(profile)
+        systems = stream.systems
+
+        t = time.process_time()
+        if kind in NAMES:
+            systems.add(data)
+        else:
+            systems.add_transmission(transmission)
+        cpu['decode'] += time.process_time() - t
+        rows = max(rows, len(systems.systems))
+        if kind in OUTGOING:
+            t = time.process_time()
+            stream.encode(systems.data)
+            cpu['encode'] += time.process_time() - t
+        systems.commit()
+        counters[kind] += 1
+
+    def received(incoming):
+        return sum(stream.systems.received
+                   for (i, _), stream in streams.items() if i == incoming)
+
+    return {
+        'skipped': counters['skipped'],
+        'streams': len(streams),
+        'span': at - first if first is not None else 0.0,
+        'elapsed': time.monotonic() - started,
+        'decode_cpu': cpu['decode'],
+        'encode_cpu': cpu['encode'],
+        'rows_peak': rows,
+        'transmissions_in': sum(counters[k] for k in INCOMING),
+        'transmissions_out': sum(counters[k] for k in OUTGOING),
+        'bytes_in': received(True),
+        'bytes_out': received(False),
+    }
+
+
+# --engines: the client and the server in one process per engine, on
+# loopback with an echo endpoint: seconds from launch to listening (imports
+# included, it gates ssh logins), round trips of small messages, goodput and
+# cpu time of a bulk transfer
+ENGINES = ('twisted', 'asyncio')
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def echo(listener):
+    def serve(conn):
+        with conn:
+            for chunk in iter(lambda: conn.recv(65536), b''):
+                conn.sendall(chunk)
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def recv_exactly(conn, size):
+    got = b''
+    while len(got) < size:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        got += chunk
+    return got
+
+
+def measure(port, pings, size):
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.settimeout(60)
+    with conn:
+        rtts = []
+        for i in range(pings):
+            ping = b'ping %04d' % i
+            t = time.perf_counter()
+            conn.sendall(ping)
+            if recv_exactly(conn, len(ping)) != ping:
+                return {'ok': False}
+            rtts.append(time.perf_counter() - t)
+
+        payload = os.urandom(size)
+        t, cpu = time.perf_counter(), time.process_time()
+        sender = threading.Thread(target=conn.sendall, args=(payload,))
+        sender.start()
+        ok = recv_exactly(conn, size) == payload
+        sender.join()
+        elapsed = time.perf_counter() - t
+    rtts.sort()
+    return {
+        'ok': ok,
+        'rtt_median': rtts[len(rtts) // 2],
+        'rtt_max': rtts[-1],
+        'goodput': size / elapsed,
+        'cpu': time.process_time() - cpu,
+    }
+
+
+def engine_run(engine, pings, size):
+    # in a child process, the last line of output is the result
+    dns, endpoint, port = free_port(socket.SOCK_DGRAM), free_port(), free_port()
+    bromine.CONFIG.update(port=port, workers=0, metrics=0)
+    bromine.PROFILE.endpoint = endpoint
+    servers = [('127.0.0.1', dns)]
+    bromine.configured_resolvers = lambda: servers
+    listener = socket.create_server(('127.0.0.1', endpoint))
+    threading.Thread(target=echo, args=(listener,), daemon=True).start()
+    result = {'engine': engine}
+
+    if engine == 'twisted':
+        from twisted.internet import reactor
+        import client
+        import server
+        reactor.listenUDP(dns, server.p, interface='127.0.0.1')
+        reactor.listenTCP(port, client.ClientFactory(), interface='127.0.0.1')
+        result['ready_at'] = time.time()
+
+        def run():
+            result.update(measure(port, pings, size))
+            reactor.callFromThread(reactor.stop)
+        reactor.callWhenRunning(threading.Thread(target=run).start)
+        reactor.run()
+    else:
+        import asyncio
+        import bromine.aio as aio
+
+        async def run():
+            await aio.Server().start(dns)
+            await aio.Client(servers, 1).start(port)
+            result['ready_at'] = time.time()
+            loop = asyncio.get_running_loop()
+            result.update(await loop.run_in_executor(
+                None, measure, port, pings, size))
+        asyncio.run(run())
+    print(json.dumps(result))
+
+
+def engines(pings, size, timeout=600):
+    results = []
+    for engine in ENGINES:
+        launched = time.time()
+        try:
+            done = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--engine-run',
+                 engine, '--pings', str(pings), '--bulk', str(size)],
+                capture_output=True, text=True, timeout=timeout)
+            result = json.loads(done.stdout.splitlines()[-1])
+        except (subprocess.TimeoutExpired, IndexError, ValueError):
+            results.append({'engine': engine, 'ok': False})
+            continue
+        result['startup'] = result.pop('ready_at') - launched
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='bromine link benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--upload', type=int, default=20000)
+    parser.add_argument('--download', type=int, default=20000)
+    parser.add_argument('--chunk', type=int, default=512)
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--loss', type=float, default=0.05)
+    parser.add_argument('--duplicate', type=float, default=0.01)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--capacity', type=float, default=None)
+    parser.add_argument('--limit', type=float, default=120.0)
+    parser.add_argument('--baseline', help='json from a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--tune', action='store_true',
+                        help='TUNE = 1 on top of every setting')
+    parser.add_argument('--micro', action='store_true',
+                        help='time address encoding only')
+    parser.add_argument('--engines', action='store_true',
+                        help='twisted against asyncio, on loopback')
+    parser.add_argument('--engine-run', choices=ENGINES, help=argparse.SUPPRESS)
+    parser.add_argument('--pings', type=int, default=10)
+    parser.add_argument('--bulk', type=int, default=200000)
+    parser.add_argument('--replay', help='a file from TRACE, see config.ini')
+    parser.add_argument('--timing', action='store_true',
+                        help='replay at the pace it was recorded')
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        json.dump(micro(args.seed), sys.stdout, indent=1)
+        print()
+        return 0
+
+    if args.engine_run is not None:
+        engine_run(args.engine_run, args.pings, args.bulk)
+        return 0
+
+    if args.engines:
+        json.dump(engines(args.pings, args.bulk), sys.stdout, indent=1)
+        print()
+        return 0
+
+    if args.replay is not None:
+        json.dump(replay(args.replay, args.timing), sys.stdout, indent=1)
+        print()
+        return 0
+
+    options = vars(args).copy()
+    for name in ('micro', 'engines', 'engine_run', 'pings', 'bulk',
+                 'replay', 'timing'):
+        options.pop(name)
+    baseline = options.pop('baseline')
+    tolerance = options.pop('tolerance')
+    tune = {'tune': 1} if options.pop('tune') else {}
+
+    results = [bench(dict(settings, **tune), **options)
+               for settings in matrix()]
+    json.dump(results, sys.stdout, indent=1)
+    print()
+
+    if baseline is not None:
+        with open(baseline) as f:
+            found = regressions(results, json.load(f), tolerance)
+        for settings, name, before, after in found:
+            print('regression', key(settings), name, before, '->', after,
+                  file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,632 @@
+import argparse
+import asyncio
+import os
+import pwd
+import random
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+import bromine
+
+# the client and the server on asyncio, without twisted: the pumps of
+# client.py and server.py, see ClientPump, ServerPump and Responder, over a
+# dns wire format cut down to what bromine sends and answers.
+# Pick it with ENGINE = asyncio in config.ini, or run
+# `python -m bromine.aio client|server [--testing]`
+
+# https://www.rfc-editor.org/rfc/rfc1035#section-4.1
+HEADER_FORMAT = "!HHHHHH"  # id, flags, qd, an, ns and ar counts
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RR_FORMAT = "!HHIH"  # type, class, ttl, rdlength, after the owner name
+RR_SIZE = struct.calcsize(RR_FORMAT)
+FLAG_QR = 0x8000  # a response
+FLAG_OPCODE = 0x7800
+FLAG_AA = 0x0400
+FLAG_RD = 0x0100
+RCODE_MASK = 0x000f
+POINTER = 0xc0
+OWNER = 0xc000 | HEADER_SIZE  # points at the name of the question
+
+CLASS_IN = 1
+TYPE_OPT = 41  # https://www.rfc-editor.org/rfc/rfc6891
+QUERY_TYPES = {'cname': 5, 'txt': 16, 'null': 10, 'aaaa': 28}
+MODES = {v: k for k, v in QUERY_TYPES.items()}
+
+RCODE_OK = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3  # the server does not know the channel as ours
+
+# see client.py
+EDNS_SIZE = 1232
+FAST = 1e-2
+
+
+class WireError(ValueError):
+    pass
+
+
+def encode_name(name):
+    labels = [label for label in name.split(b'.') if label]
+    return b''.join(bytes([len(label)]) + label for label in labels) + b'\0'
+
+
+def decode_name(packet, offset):
+    # the name at offset, and where what follows it starts
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = packet[offset]
+        if length & POINTER == POINTER:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", packet, offset)[0] & 0x3fff
+            jumps += 1
+            if jumps > 127:
+                raise WireError("compression loop")
+        elif length == 0:
+            return b'.'.join(labels), offset + 1 if end is None else end
+        else:
+            labels.append(packet[offset + 1:offset + 1 + length])
+            offset += 1 + length
+
+
+def opt_record(udp_size):
+    # root owner, the class is the udp payload size
+    return b'\0' + struct.pack(RR_FORMAT, TYPE_OPT, udp_size, 0, 0)
+
+
+def make_query(qid, name, qtype, udp_size=EDNS_SIZE):
+    # no OPT record when udp_size is None
+    additional = 0 if udp_size is None else 1
+    header = struct.pack(HEADER_FORMAT, qid, FLAG_RD, 1, 0, 0, additional)
+    question = encode_name(name) + struct.pack("!HH", qtype, CLASS_IN)
+    opt = b'' if udp_size is None else opt_record(udp_size)
+    return header + question + opt
+
+
+def skip_records(packet, offset, count):
+    # yields type, class, rdata offset and length of each record
+    for _ in range(count):
+        _, offset = decode_name(packet, offset)
+        rtype, rclass, _, rdlength = struct.unpack_from(RR_FORMAT, packet,
+                                                        offset)
+        offset += RR_SIZE
+        if offset + rdlength > len(packet):
+            raise WireError("truncated record")
+        yield rtype, rclass, offset, rdlength
+        offset += rdlength
+
+
+def parse_query(packet):
+    # qid, flags, name, type, raw question, udp size (None without OPT)
+    qid, flags, qd, an, ns, ar = struct.unpack_from(HEADER_FORMAT, packet)
+    if flags & FLAG_QR or qd != 1:
+        raise WireError("not a query")
+    name, offset = decode_name(packet, HEADER_SIZE)
+    qtype, _ = struct.unpack_from("!HH", packet, offset)
+    question = packet[HEADER_SIZE:offset + 4]
+    udp_size = None
+    for rtype, rclass, _, _ in skip_records(packet, offset + 4, an + ns + ar):
+        if rtype == TYPE_OPT:
+            udp_size = rclass
+    return qid, flags, name, qtype, question, udp_size
+
+
+def make_response(qid, flags, question, rcode, qtype=0, rdatas=(),
+                  udp_size=None):
+    # every answer is owned by the question's name
+    flags = FLAG_QR | FLAG_AA | flags & (FLAG_OPCODE | FLAG_RD) | rcode
+    additional = 0 if udp_size is None else 1
+    header = struct.pack(HEADER_FORMAT, qid, flags, 1, len(rdatas), 0,
+                         additional)
+    answers = b''.join(
+        struct.pack("!H" + RR_FORMAT[1:], OWNER, qtype, CLASS_IN, 0,
+                    len(rdata)) + rdata
+        for rdata in rdatas)
+    opt = b'' if udp_size is None else opt_record(udp_size)
+    return header + question + answers + opt
+
+
+def to_rdatas(mode, items):
+    # what server.py builds records of, on the wire
+    if mode == 'cname':
+        return [encode_name(host) for host in items]
+    records = bromine.to_records(mode, items)
+    if mode == 'txt':
+        return [b''.join(bytes([len(s)]) + s for s in strings)
+                for strings in records]
+    return records
+
+
+def rdata_value(packet, offset, length, mode):
+    # what client.py reads off twisted's records
+    if mode == 'cname':
+        return decode_name(packet, offset)[0]
+    rdata = packet[offset:offset + length]
+    if mode == 'txt':
+        strings = []
+        i = 0
+        while i < len(rdata):
+            strings.append(rdata[i + 1:i + 1 + rdata[i]])
+            i += 1 + rdata[i]
+        return strings
+    return rdata
+
+
+def parse_response(packet, mode):
+    # qid, rcode and the values of the answers of our type
+    qid, flags, qd, an, _, _ = struct.unpack_from(HEADER_FORMAT, packet)
+    if not flags & FLAG_QR:
+        raise WireError("not a response")
+    offset = HEADER_SIZE
+    for _ in range(qd):
+        _, offset = decode_name(packet, offset)
+        offset += 4
+    qtype = QUERY_TYPES[mode]
+    values = [rdata_value(packet, i, length, mode)
+              for rtype, _, i, length in skip_records(packet, offset, an)
+              if rtype == qtype]
+    return qid, flags & RCODE_MASK, values
+
+
+class Every:
+    # LoopingCall counterpart, on the running loop
+    def __init__(self, interval, f, now=True):
+        self.interval = interval
+        self.f = f
+        self.loop = asyncio.get_event_loop()
+        self.handle = self.loop.call_later(0 if now else interval, self.tick)
+
+    def tick(self):
+        self.handle = self.loop.call_later(self.interval, self.tick)
+        self.f()
+
+    def stop(self):
+        self.handle.cancel()
+
+
+def log(*args):
+    print(*args, flush=True)
+
+
+class Queries(asyncio.DatagramProtocol):
+    # the client's queries, every session and upstream on one socket per
+    # address family, replies matched by id and source
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # qid -> (session, upstream, sent_at, poll, timer)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, session, upstream, host, timeout, sent_at, poll=False):
+        qid = random.getrandbits(16)
+        while qid in self.pending:
+            qid = random.getrandbits(16)
+        packet = make_query(qid, host, QUERY_TYPES[session.mode])
+        loop = asyncio.get_event_loop()
+        timer = loop.call_later(timeout, self.timeout, qid)
+        self.pending[qid] = (session, upstream, sent_at, poll, timer)
+        try:
+            self.transport.sendto(packet, upstream.address)
+        except OSError:
+            self.pending.pop(qid)
+            timer.cancel()
+            loop.call_soon(session.failed, upstream, sent_at, False, poll)
+
+    def timeout(self, qid):
+        session, upstream, sent_at, poll, _ = self.pending.pop(qid)
+        session.failed(upstream, sent_at, True, poll)
+
+    def datagram_received(self, data, address):
+        if len(data) < HEADER_SIZE:
+            return
+        qid = struct.unpack_from("!H", data)[0]
+        entry = self.pending.get(qid)
+        if entry is None or entry[1].address != address[:2]:
+            return
+        session, upstream, sent_at, poll, timer = entry
+        try:
+            _, rcode, values = parse_response(data, session.mode)
+        except (IndexError, struct.error, WireError):
+            return  # the timeout takes care of it
+        del self.pending[qid]
+        timer.cancel()
+        session.ok_(rcode, values, upstream, sent_at, poll)
+
+    def error_received(self, exc):
+        pass  # icmp unreachable and the like, the timeouts tell
+
+
+class Session(bromine.ClientPump, asyncio.Protocol):
+    # SocketInDns counterpart, one per local connection
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+        self.loop = asyncio.get_event_loop()
+        bromine.ClientPump.__init__(self, client.servers, client.mode)
+
+    def now(self):
+        return self.loop.time()
+
+    def later(self):
+        self.loop.call_later(FAST, self.pump)
+
+    def connection_made(self, transport):
+        log("connection from", transport.get_extra_info('peername'))
+        self.transport = transport
+        self.backpressure = bromine.Backpressure(
+            transport.pause_reading, transport.resume_reading)
+        self.looping = Every(self.client.slow, self.pump)
+
+    def connection_lost(self, exc):
+        # what is in flight or in the backlog still goes through
+        self.closed = True
+        if bromine.METRICS.enabled:
+            bromine.METRICS.uncollect(self.collect)
+
+    def data_received(self, data):
+        self.score_board.push_data(data)
+        self.throttle()
+        self.later()
+
+    def throttle(self):
+        # see SocketInDns.throttle()
+        self.backpressure.update(self.score_board.backlog.pending)
+
+    def send_query(self, host, upstream, timeout, sent_at, poll):
+        queries = self.client.queries_for(upstream)
+        queries.send(self, upstream, host, timeout, sent_at, poll)
+
+    def deliver(self, data):
+        if not self.closed:
+            self.transport.write(data)
+
+    def stop(self):
+        self.looping.stop()
+
+    def lose(self):
+        self.transport.close()
+
+    def ok_(self, rcode, values, upstream, sent_at, poll=False):
+        if rcode == RCODE_NXDOMAIN:
+            # the server does not know our channel as ours
+            self.unknown(upstream, sent_at, poll)
+        elif rcode != RCODE_OK:
+            # SERVFAIL and friends, the resolver gave up on this one
+            self.failed(upstream, sent_at, False, poll)
+        else:
+            self.received(values, upstream, sent_at, poll)
+
+
+class MuxSession(bromine.MuxClientPump, Session):
+    # MuxChannel counterpart, without a connection of its own
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.get_event_loop()
+        bromine.MuxClientPump.__init__(self, client.servers, client.mode)
+        self.looping = Every(client.slow, self.pump)
+
+
+class MuxStream(asyncio.Protocol):
+    def __init__(self, session):
+        self.session = session
+        self.sid = None
+
+    def connection_made(self, transport):
+        log("connection from", transport.get_extra_info('peername'))
+        self.transport = transport
+        self.backpressure = bromine.Backpressure(
+            transport.pause_reading, transport.resume_reading,
+            bromine.MUX_BUFFER_HIGH, bromine.MUX_BUFFER_LOW)
+        self.sid = self.session.open(self)
+        if self.sid is None:
+            transport.close()  # every stream id is taken
+
+    def data_received(self, data):
+        self.session.write(self.sid, data)
+        self.throttle()
+
+    def throttle(self):
+        self.backpressure.update(self.session.mux.buffered(self.sid))
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.sid is not None:
+            self.session.close(self.sid)
+
+
+class Client:
+    def __init__(self, servers, slow, mode=None):
+        self.servers = servers
+        self.slow = slow
+        self.mode = mode or bromine.CONFIG.get('downstream', 'cname')
+        self.queries = {}  # address family -> Queries
+        self.session = None  # with MUX, see build()
+
+    def build(self):
+        if not bromine.PROFILE.mux:
+            return Session(self)
+        if self.session is None or self.session.done:
+            self.session = MuxSession(self)
+        return MuxStream(self.session)
+
+    async def start(self, port):
+        loop = asyncio.get_event_loop()
+        for family in {family_of(a) for a in self.servers}:
+            any_ = '::' if family == socket.AF_INET6 else '0.0.0.0'
+            _, self.queries[family] = await loop.create_datagram_endpoint(
+                Queries, local_addr=(any_, 0), family=family)
+        return await loop.create_server(self.build, '0.0.0.0', port)
+
+    def queries_for(self, upstream):
+        return self.queries[family_of(upstream.address)]
+
+
+def family_of(address):
+    return socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+
+
+class Channel(bromine.ServerPump, asyncio.Protocol):
+    # SocketPump counterpart
+    def __init__(self, channel_id, mode='cname', profile=bromine.PROFILE):
+        bromine.ServerPump.__init__(self, channel_id, mode, profile)
+        self.transport = None
+        self.backpressure = None  # once connected
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.backpressure = bromine.Backpressure(
+            transport.pause_reading, transport.resume_reading)
+
+    def data_received(self, data):
+        self.score_board.push_data(data)
+        self.throttle()
+        self.wake()
+
+    def throttle(self):
+        # see SocketPump.throttle()
+        if self.backpressure is not None:
+            self.backpressure.update(self.score_board.backlog.pending)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def ready(self):
+        return self.transport is not None
+
+    def deliver(self, data):
+        self.transport.write(data)
+
+
+class MuxPump(bromine.MuxServerPump):
+    # server.py's MuxPump counterpart
+    def __init__(self, channel_id, mode='cname', profile=bromine.PROFILE):
+        bromine.MuxServerPump.__init__(self, channel_id, mode, profile)
+        self.loop = asyncio.get_event_loop()
+
+    def upstream(self, sid):
+        return MuxUpstream(self, sid)
+
+
+class MuxUpstream(asyncio.Protocol):
+    def __init__(self, pump, sid):
+        self.pump = pump
+        self.sid = sid
+        self.transport = None
+        self.early = []  # written before we connected
+        self.closed = False
+        self.backpressure = None  # once connected
+
+    def connect(self):
+        self.pump.loop.create_task(self.connecting())
+
+    async def connecting(self):
+        try:
+            await self.pump.loop.create_connection(
+                lambda: self, 'localhost', self.pump.profile.endpoint)
+        except OSError as e:
+            log('endpoint:', e)
+            self.pump.lost(self.sid, self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.backpressure = bromine.Backpressure(
+            transport.pause_reading, transport.resume_reading,
+            bromine.MUX_BUFFER_HIGH, bromine.MUX_BUFFER_LOW)
+        for data in self.early:
+            transport.write(data)
+        self.early = None
+        if self.closed:
+            transport.close()
+
+    def write(self, data):
+        if self.early is not None:
+            self.early.append(data)
+        else:
+            self.transport.write(data)
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def data_received(self, data):
+        self.pump.mux.write(self.sid, data)
+        self.throttle()
+        self.pump.wake()
+
+    def throttle(self):
+        if self.backpressure is not None:
+            self.backpressure.update(self.pump.mux.buffered(self.sid))
+
+    def connection_lost(self, exc):
+        self.pump.lost(self.sid, self)
+
+
+class Server(bromine.Responder):
+    # DnsInSocket and EdnsServerFactory counterpart
+    def __init__(self, profiles=bromine.PROFILES):
+        bromine.Responder.__init__(self, profiles)
+        self.loop = asyncio.get_event_loop()
+
+    def now(self):
+        return self.loop.time()
+
+    def later(self, delay, f):
+        return self.loop.call_later(delay, f)
+
+    def cancel(self, timer):
+        timer.cancel()
+
+    def open_channel(self, chid, mode, profile):
+        if profile.mux:
+            # streams connect on their own
+            return MuxPump(chid, mode, profile)
+        socket = Channel(chid, mode, profile)
+        self.loop.create_task(self.connect(socket))
+        return socket
+
+    async def connect(self, socket):
+        try:
+            await self.loop.create_connection(
+                lambda: socket, 'localhost', socket.profile.endpoint)
+        except OSError as e:
+            log('endpoint:', e)
+
+    def handle(self, packet, tcp, send):
+        try:
+            qid, flags, name, qtype, question, udp_size = parse_query(packet)
+        except (IndexError, struct.error, WireError):
+            return
+
+        # let the answer know how much the client can take in, our OPT
+        # record only goes to a query that had one
+        size = udp_size
+        if tcp:
+            size = 65535
+        elif size is not None:
+            size = max(bromine.UDP_SIZE, size)
+        opt = None if udp_size is None else size
+
+        mode = MODES.get(qtype)
+        if mode is None:
+            # we do not relay anything
+            send(make_response(qid, flags, question, RCODE_SERVFAIL))
+            return
+
+        # the OPT record is the query's own, cached answer or not
+        def reply(items):
+            send(make_response(qid, flags, question, RCODE_OK, qtype,
+                               to_rdatas(mode, items), opt))
+        try:
+            self.answer(name, mode, size, reply)
+        except bromine.UnknownChannel:
+            send(make_response(qid, flags, question, RCODE_NXDOMAIN))
+        except Exception:
+            traceback.print_exc()
+            send(make_response(qid, flags, question, RCODE_SERVFAIL))
+
+    async def start(self, port):
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerDatagram(self), local_addr=('0.0.0.0', port))
+        stream = await asyncio.start_server(self.serve_stream, '0.0.0.0', port)
+        Every(bromine.CHANNEL_IDLE / 10, self.reap)
+        return transport, stream
+
+    async def serve_stream(self, reader, writer):
+        # two bytes of length, then a message, both ways
+        def send(reply):
+            if not writer.is_closing():
+                writer.write(struct.pack("!H", len(reply)) + reply)
+        try:
+            while True:
+                size, = struct.unpack("!H", await reader.readexactly(2))
+                self.handle(await reader.readexactly(size), True, send)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class ServerDatagram(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        def send(reply):
+            self.transport.sendto(reply, address)
+        self.server.handle(data, False, send)
+
+
+def drop_privileges():
+    # what twistd does for server.py's application: root's supplementary
+    # groups go first, then the group, the user last
+    if os.getuid() == 0:
+        nobody = pwd.getpwnam("nobody")
+        os.setgroups([])
+        os.setgid(nobody.pw_gid)
+        os.setuid(nobody.pw_uid)
+
+
+def log_metrics():
+    log('metrics', bromine.METRICS.line())
+
+
+async def run(args):
+    if args.role == 'client':
+        if args.testing:
+            servers, slow = [('127.0.0.1', 5553)], 1e-2
+        else:
+            servers, slow = bromine.configured_resolvers(), 1
+        await Client(servers, slow).start(bromine.CONFIG['port'])
+    else:
+        if bromine.CONFIG.get('workers', 0) > 0:
+            log('WORKERS is not supported by the asyncio engine, ignored')
+        server = Server()
+        await server.start(5553 if args.testing else 53)
+        if not args.testing:
+            drop_privileges()
+        if bromine.METRICS.enabled:
+            bromine.METRICS.collect(server.collect)
+
+    if bromine.METRICS.enabled:
+        Every(bromine.CONFIG['metrics'], log_metrics, now=False)
+
+    if bromine.TRACE.enabled:
+        # exit rather than die of it, atexit flushes the trace
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, sys.exit)
+
+    await asyncio.Event().wait()  # until interrupted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bromine.aio',
+        description='bromine on asyncio, see ENGINE in config.ini')
+    parser.add_argument('role', choices=['client', 'server'])
+    parser.add_argument('--testing', action='store_true',
+                        help='everything on localhost, see TESTING')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
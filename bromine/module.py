@@ -1,25 +1,208 @@
+import atexit
 import base64
+import binascii
+import bisect
+import collections
 import itertools
 import configparser
+import hashlib
 import math
 import os
 import random
 import struct
+import time
+import zlib
 
 config_path = os.path.expanduser('~/.config/bromine/config.ini')
 parsed = configparser.ConfigParser()
 parsed.read(config_path)
 
-CONFIG_INT_KEYS = {'endpoint', 'port', 'n', 'reset', 'ackperiod', 'window'}
+CONFIG_INT_KEYS = {'endpoint', 'port', 'n', 'reset', 'ackperiod', 'window',
+                   'metrics', 'workers', 'mux', 'longpoll', 'tune'}
 
 
 def to_int(k, v):
     return int(v) if k in CONFIG_INT_KEYS else v
 
 
-CONFIG = {k: to_int(k, parsed['DEFAULT'][k]) for k in parsed['DEFAULT']}
-assert(CONFIG['window'] > CONFIG['ackperiod'])
-assert(CONFIG['n'] % 2 == 1)
+def section(name):
+    return {k: to_int(k, parsed[name][k]) for k in parsed[name]}
+
+
+CONFIG = section('DEFAULT')
+
+
+class Histogram:
+    # log2 buckets: cheap, and good enough for latencies and sizes
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        # value is in [2 ** (e - 1), 2 ** e), 2 ** -1075 == 0
+        e = math.frexp(value)[1] if value > 0 else -1075
+        self.buckets[e] += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile
+        seen = 0
+        for e in sorted(self.buckets):
+            seen += self.buckets[e]
+            if seen >= q * self.count:
+                return min(2.0 ** e, self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'max': self.max}
+
+
+class Metrics:
+    # counters, gauges and histograms by name; when disabled every hook
+    # returns at once, hot paths check enabled before computing anything.
+    # Collectors are called at snapshot time, for gauges that would cost
+    # something to keep up to date; gauges are those of the last snapshot,
+    # an uncollected channel's go with it.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+        self.collectors = []
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        if self.enabled:
+            self.histograms[name].observe(value)
+
+    def collect(self, collector):
+        self.collectors.append(collector)
+
+    def uncollect(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def snapshot(self):
+        self.gauges = {}
+        for collector in self.collectors:
+            collector(self)
+        snapshot = dict(self.counters)
+        snapshot.update(self.gauges)
+        for name, histogram in self.histograms.items():
+            for k, v in histogram.summary().items():
+                snapshot[name + '.' + k] = v
+        return snapshot
+
+    def line(self):
+        # for a periodic log line
+        def fmt(v): return '%.4g' % v if isinstance(v, float) else str(v)
+        return ' '.join('%s=%s' % (k, fmt(v))
+                        for k, v in sorted(self.snapshot().items()))
+
+
+# METRICS is the period of the log line in seconds, 0 turns them off
+METRICS = Metrics(CONFIG.get('metrics', 0) > 0)
+
+# with TRACE set to a path, the client and the server append to it what
+# goes in their Systems and comes out of their Scoreboards: names, and
+# transmissions of packed answers, each a record of f64 unix time | u8
+# kind | u16 length | bytes. Past TRACE_MAX bytes the file moves to
+# path.1 (the previous one goes) and a new one starts. Writes are
+# buffered, a crash loses TRACE_BUFFER bytes at most; an error (say the
+# server dropped privileges and cannot write there) turns tracing off.
+# bench.py --replay reads them.
+TRACE_FORMAT = "<dBH"
+TRACE_HEADER = struct.calcsize(TRACE_FORMAT)
+TRACE_NAME_IN = 1
+TRACE_NAME_OUT = 2
+TRACE_PACKED_IN = 3
+TRACE_PACKED_OUT = 4
+TRACE_MAX = 64 << 20
+TRACE_BUFFER = 64 << 10
+
+
+class Trace:
+    def __init__(self, path=None, limit=TRACE_MAX):
+        self.path = path
+        self.enabled = path is not None
+        self.limit = limit
+        self.file = None
+        self.size = 0
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=TRACE_BUFFER)
+        self.size = self.file.tell()
+        atexit.register(self.close)
+
+    def record(self, kind, data, now=None):
+        if not self.enabled:
+            return
+        if now is None:
+            now = time.time()
+        line = struct.pack(TRACE_FORMAT, now, kind, len(data)) + data
+        try:
+            if self.file is None:
+                self.open()
+            elif self.size + len(line) > self.limit:
+                self.close()
+                os.replace(self.path, self.path + '.1')
+                self.open()
+            self.file.write(line)
+        except OSError:
+            METRICS.count('trace.errors')
+            self.enabled = False
+            return
+        self.size += len(line)
+        METRICS.count('trace.records')
+
+    def record_all(self, kind, items):
+        if self.enabled:
+            now = time.time()
+            for data in items:
+                self.record(kind, data, now)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            atexit.unregister(self.close)
+            self.file = None
+
+
+def trace_kind(mode):
+    # of what goes out in answers, see DOWNSTREAM_MODES
+    return TRACE_NAME_OUT if mode == 'cname' else TRACE_PACKED_OUT
+
+
+def read_trace(path):
+    # (time, kind, bytes) of the records, a cut off last one is left out
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + TRACE_HEADER <= len(data):
+        at, kind, length = struct.unpack_from(TRACE_FORMAT, data, offset)
+        offset += TRACE_HEADER
+        if offset + length > len(data):
+            return
+        yield at, kind, data[offset:offset + length]
+        offset += length
+
+
+TRACE = Trace(CONFIG.get('trace'))
 
 # https://en.wikipedia.org/wiki/Hostname
 # Hostnames are composed of a series of labels concatenated with dots.
@@ -43,17 +226,6 @@ def valid_dns_name(address, explain=False):
     return valid_len and valid_subs
 
 
-def max_size():
-    if '_tiny' in CONFIG:
-        # for testing purposes
-        return CONFIG['_tiny']
-
-    domain_free_size = NAME_MAX - len(CONFIG['domain'])
-    num_dots = domain_free_size / SUB_NAME_MAX
-    to_base64 = 0.7  # theoritically 3/4, but we have small strings
-    return int((domain_free_size - num_dots) * to_base64)
-
-
 def to_b64(data):
     b64 = base64.b64encode(data, b'-_')
     return b64.replace(b'=', b'')
@@ -65,58 +237,134 @@ def from_b64(data):
     return base64.b64decode(data + missing_padding, b'-_')
 
 
-def to_address(data):
-    if '_fickle' in CONFIG and random.random() < CONFIG['_fickle']:
-        # for testing purposes
-        return None
+# codecs turn bytes into the body of a name, an address starts with the tag
+# of its codec, except for base64 which predates them (see to_address)
+class Base64Codec:
+    # url safe base64: dense, but resolvers doing 0x20 randomization or
+    # lowercasing names corrupt it
+    name = 'base64'
+    tag = None
 
-    assert(len(data) > 0)
-    tail = CONFIG['domain'].encode("ascii")
+    def encode(self, data):
+        return to_b64(data)
 
-    def insert_dots(split):
-        body = b'.'.join(
-            b64[e:(e+split)] for e in range(0, len(b64), split))
-        full_address = b'_' + body + b'.' + tail
-        if valid_dns_name(full_address):
-            return full_address
-        return None
+    def decode(self, body):
+        return from_b64(body)
 
-    b64 = to_b64(data)
+    def capacity(self, chars):
+        return chars * 3 // 4
 
-    dotted = insert_dots(SUB_NAME_MAX - 1)
-    if dotted is not None:
-        return dotted
 
-    # replace some char by dots
-    chars = list(set(b64) - set(b"-_"))
-    random.shuffle(chars)  # reduce duplicate requests
-    for c in chars:
-        as_byte = c.to_bytes(1, byteorder='little')
-        candidate = b64.replace(as_byte, b'.')
-        full_address = as_byte + candidate + b'.' + tail
-        if valid_dns_name(full_address):
-            return full_address
+class Base32Codec:
+    # lowercase rfc 4648 base32, no padding, survives any case mangling
+    name = 'base32'
+    tag = b'3'
 
-    # margin is how many dots we can fit in the body
-    # 2 stands for the first "_" & the connecting "." between body and tail
-    margin = NAME_MAX - len(b64) - len(tail) - 2
-    min_split = int(len(b64) / margin)
-    for split in range(min_split, SUB_NAME_MAX - 2):
-        dotted = insert_dots(split)
-        if dotted is not None:
-            return dotted
+    def encode(self, data):
+        return base64.b32encode(data).rstrip(b'=').lower()
 
-    return None
+    def decode(self, body):
+        missing_padding = b'=' * (-len(body) % 8)
+        return base64.b32decode(body.upper() + missing_padding)
 
+    def capacity(self, chars):
+        return chars * 5 // 8
 
-def from_address(address):
-    first = address[0].to_bytes(1, byteorder='little')
-    sub = address[1:-1-len(CONFIG['domain'])]
 
-    if first == b'_':
-        return from_b64(sub.replace(b'.', b''))
+class Base36Codec:
+    # the whole payload as one big number written with [0-9a-z],
+    # left padded so that the length alone gives back the payload length
+    name = 'base36'
+    tag = b'6'
+    ALPHABET = b'0123456789abcdefghijklmnopqrstuvwxyz'
+
+    def encoded_size(self, size):
+        # smallest number of digits that can hold size bytes
+        chars = math.ceil(size * 8 / math.log2(36))
+        while chars > 0 and 36 ** (chars - 1) >= 256 ** size:
+            chars -= 1
+        while 36 ** chars < 256 ** size:
+            chars += 1
+        return chars
+
+    def capacity(self, chars):
+        # largest size with 256 ** size <= 36 ** chars
+        return ((36 ** chars).bit_length() - 1) // 8
+
+    def encode(self, data):
+        number = int.from_bytes(data, byteorder='big')
+        digits = bytearray()
+        while number > 0:
+            number, digit = divmod(number, 36)
+            digits.append(self.ALPHABET[digit])
+        digits.extend(b'0' * (self.encoded_size(len(data)) - len(digits)))
+        digits.reverse()
+        return bytes(digits)
+
+    def decode(self, body):
+        number = int(body, 36) if len(body) > 0 else 0
+        return number.to_bytes(self.capacity(len(body)), byteorder='big')
 
-    return from_b64(sub.replace(b'.', first))
+
+CODECS = {codec.name: codec
+          for codec in (Base64Codec(), Base32Codec(), Base36Codec())}
+CODEC_TAGS = {codec.tag: codec for codec in CODECS.values()
+              if codec.tag is not None}
+
+
+# base64 names are a marker then the body, dotted every SUB_NAME_MAX chars.
+# A label cannot start with '-': when one would, the body swaps '-' with a
+# char that starts no label, and that char is the marker instead of '_'.
+# Both ways are a single bytes.translate from/to standard base64.
+SWAP_CHARS = bytes(c for c in b'abcdefghijklmnopqrstuvwxyz'
+                   b'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+                   if bytes([c]) not in CODEC_TAGS)
+
+
+def swap_tables(swap):
+    if swap is None:
+        return bytes.maketrans(b'+/', b'-_'), bytes.maketrans(b'-_', b'+/')
+    c = bytes([swap])
+    encode = bytes.maketrans(b'+/' + c, c + b'_-')
+    decode = bytes.maketrans(c + b'_-', b'+/' + c)
+    return encode, decode
+
+
+B64_TABLES = {swap: swap_tables(swap) for swap in (None,) + tuple(SWAP_CHARS)}
+
+
+def get_codec(name=None):
+    if name is None:
+        name = PROFILE.codec
+    return CODECS[name]
+
+
+def address_codec(address):
+    first = address[:1]
+    return CODEC_TAGS.get(first, CODECS['base64']).name
+
+
+def body_chars(tail):
+    # how many codec chars fit in front of tail, one goes to the
+    # marker/tag, one dot every SUB_NAME_MAX chars, one before tail
+    free = NAME_MAX - 1 - 1 - len(tail)
+    chars = free
+    while chars + (chars - 1) // SUB_NAME_MAX > free:
+        chars -= 1
+    return chars - 1
+
+
+# the ones of the DEFAULT profile, see TunnelProfile
+def max_size(codec=None):
+    return PROFILE.max_size(codec)
+
+
+def to_address(data, codec=None):
+    return PROFILE.to_address(data, codec)
+
+
+def from_address(address):
+    return PROFILE.from_address(address)
 
 # https://docs.python.org/3/library/struct.html#functions-and-exceptions
 # https://docs.python.org/3/library/stdtypes.html#int.to_bytes
@@ -124,75 +372,157 @@ def from_address(address):
 
 # one transmission is:
 # transmission = chid | mid_0 | ... | mid_N | payload_transmission
-# u8 channel_id = chid encodes a number to allow for multiple clients
+# u32 channel_id = chid encodes a number to allow for multiple clients
 # u16 message_id = mid helps us do xor-encoding of messages
 # N is a config number, reflecting the complexity of our systems
-# For data, the total overhead in byte equals 1 for chid, + 2 * n for system header, + 1 for payload type, + 1 for data length
-# mids make up a ringbuffer like structure, where we reuse old mids when we reach the end of the allotment (see CONFIG['reset'])
+# For data, the total overhead in byte equals 4 for chid, + 6 for the piggybacked ack, + 2 * n for system header, + 1 for payload type
+# mids make up a ringbuffer like structure, where we reuse old mids when we reach the end of the allotment (see TunnelProfile.reset)
+# once the remote said it understands them (FEATURE_PIGGYBACK), a transmission
+# starts with chid, PIGGYBACK_ESCAPE (never a mid), u16 local last seen remote
+# mid and u16 local oldest mid, then the mids; standalone acks are then only
+# sent when there is nothing to mix. Room for that header is always kept,
+# slices cut before the switch must still fit after it.
+# With FEATURE_SACK, the escape comes again after the ack with a u16 bitmap
+# of the mids after last seen we miss (bit i for
+# profile.successor(last_seen, i + 1)), the sender leads its next systems
+# with those.
+
+
+CHID_FORMAT = "<I"
+CHID_SIZE = struct.calcsize(CHID_FORMAT)
+PIGGYBACK_ESCAPE = 0xffff
+PIGGYBACK_FORMAT = "<HHH"
+PIGGYBACK_SIZE = struct.calcsize(PIGGYBACK_FORMAT)
+SACK_FORMAT = "<HH"
+SACK_SIZE = struct.calcsize(SACK_FORMAT)
+SACK_BITS = 16
+STEER_AGAIN = 8  # reports before a mid still missing is steered again
+
+
+def overhead(n):
+    return CHID_SIZE + PIGGYBACK_SIZE + SACK_SIZE + 2 * n + 1
 
 
-OVERHEAD = 1 + 2 * CONFIG['n'] + 1
 TYPE_NONE = 0  # invalid
 # payload ACK: u16 remote last seen mid + u16 local oldest (smallest in the ringbuffer order) mid + random bytes
 # payload DATA: bytes[length]
+# payload ZDATA: bytes[length] of the channel's raw deflate stream
 TYPE_ACK = 1
 TYPE_DATA = 2
+TYPE_ZDATA = 3
+
+# after its two mids, an ack may carry ACK_MAGIC, a bitfield of what
+# the sender understands and ACK_CHECK; older acks hold random padding
+# there, and a false positive on FEATURE_ZLIB would have us send ZDATA to
+# a remote that cannot inflate it: no feature counts without ACK_CHECK.
+# FEATURE_TUNE says a report follows, see Tuner; older receivers take it
+# for padding
+ACK_MAGIC = 0xb7
+ACK_CHECK = b'\x5e\x1f\x0b\x7a'
+FEATURE_ZLIB = 1
+FEATURE_PIGGYBACK = 2
+FEATURE_SACK = 4
+FEATURE_TUNE = 8
+REPORT_FORMAT = "<HHH"
+REPORT_SIZE = struct.calcsize(REPORT_FORMAT)
+COMPRESS_LEVEL = 6
+
+# with LONGPOLL, the payload of the client's header only transmissions
+# starts with POLL_CHECK when the server may hold the query until it has
+# data, or for LONGPOLL_HOLD seconds (well below what resolvers wait for
+# an authoritative answer); older servers answer those right away
+POLL_CHECK = b'\x3d\xa2\x91'
+LONGPOLL_HOLD = 1.0
+
+
+# downstream, the server can also answer with records carrying transmissions
+# as raw bytes: a TXT record (strings of up to 255 bytes), a NULL record,
+# or AAAA records (a sequence number and 15 bytes each); those hold a blob
+# of u8 length prefixed transmissions, a zero length ends it
+DOWNSTREAM_MODES = ('cname', 'txt', 'null', 'aaaa')
+PACKED_MAX = 255  # largest transmission in a packed answer
+TXT_STRING_MAX = 255
+AAAA_CHUNK = 15
+RR_OVERHEAD = 12  # compressed owner name, type, class, ttl, rdlength
+OPT_SIZE = 11
+
+
+def pack_transmissions(transmissions):
+    return b''.join(struct.pack("<B", len(t)) + t for t in transmissions)
+
+
+def unpack_transmissions(blob):
+    transmissions = []
+    start = 0
+    while start < len(blob) and blob[start] > 0:
+        end = start + 1 + blob[start]
+        transmissions.append(blob[start + 1:end])
+        start = end
+    return transmissions
+
+
+def to_records(mode, transmissions):
+    # rdata for each record of the answer
+    blob = pack_transmissions(transmissions)
+    if mode == 'txt':
+        return [[blob[e:(e+TXT_STRING_MAX)]
+                 for e in range(0, len(blob), TXT_STRING_MAX)]]
+    if mode == 'null':
+        return [blob]
+    if mode == 'aaaa':
+        return [struct.pack("<B", i) + blob[e:(e+AAAA_CHUNK)].ljust(AAAA_CHUNK, b'\0')
+                for i, e in enumerate(range(0, len(blob), AAAA_CHUNK))]
+    assert(not "not a packed mode")
+
+
+def from_records(mode, records):
+    if mode == 'txt':
+        blob = b''.join(b''.join(strings) for strings in records)
+    elif mode == 'null':
+        blob = b''.join(records)
+    elif mode == 'aaaa':
+        # resolvers shuffle records around
+        blob = b''.join(r[1:] for r in sorted(records, key=lambda r: r[0]))
+    else:
+        assert(not "not a packed mode")
+    return unpack_transmissions(blob)
 
 
-def generate_channel_id():
-    return random.randint(1, 255)
-
-
-def get_channel_id(transmission):
-    return struct.unpack_from("<B", transmission)[0]
-
-
-def ring_distances(x, y):
-    min_ = min(x, y)
-    max_ = max(x, y)
-    end = CONFIG['reset']
-    direct = max_ - min_
-    circular = end - max_ + min_
-    return (direct, circular)
+def answer_size(mode, count, size):
+    # bytes the answer section takes for count transmissions of size
+    if mode == 'cname':
+        return count * (RR_OVERHEAD + NAME_MAX + 2)
+    blob = count * (size + 1)
+    if mode == 'txt':
+        return RR_OVERHEAD + blob + math.ceil(blob / TXT_STRING_MAX)
+    if mode == 'null':
+        return RR_OVERHEAD + blob
+    chunks = math.ceil(blob / AAAA_CHUNK)
+    return chunks * (RR_OVERHEAD + 1 + AAAA_CHUNK) if chunks <= 256 else math.inf
 
 
-def ring_difference(x, y):
-    return min(ring_distances(x, y))
+def answer_count(mode, space, size):
+    # how many transmissions fit in space bytes, at least one
+    count = 1
+    while answer_size(mode, count + 1, size) <= space:
+        count += 1
+    return count
 
 
-def ring_compare(x, y):
-    # old school cmp like function
-    if x == y:
-        return 0
+def generate_channel_id():
+    # thousands of channels rarely collide, the server spots those that do,
+    # see ChannelTable
+    return random.randint(1, 2 ** (8 * CHID_SIZE) - 1)
 
-    direct, circular = ring_distances(x, y)
 
-    if circular < direct:
-        # it is likely we wrapped
-        if x < y:
-            # x is close to 0, y close to the end
-            # so x is greater than y
-            return 1
-        else:
-            return -1
-    else:
-        if x < y:
-            # x and y are in the middle of the buffer,
-            # classic order applies
-            return -1
-        else:
-            return 1
+def get_channel_id(transmission):
+    return struct.unpack_from(CHID_FORMAT, transmission)[0]
 
 
+# mids live on a ring of each profile's reset, see TunnelProfile
 INVALID_MID = 0
 
 
-def ring_successor(mid, n=1):
-    end = CONFIG['reset']
-    # dont use 0, or end
-    return 1 + (mid + n - 1) % (end - 1)
-
-
 def random_count(upper):
     # we want an int for the size of the system,
     # we like small even numbers
@@ -211,15 +541,82 @@ def random_count(upper):
     return k
 
 
+class AliasTable:
+    # Vose's alias method: O(1) draws from a fixed discrete distribution
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def sample(self):
+        i = int(random.random() * len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+SOLITON_C = 0.1
+SOLITON_DELTA = 0.5
+
+
+def robust_soliton(k):
+    # LT code degree distribution for k source symbols,
+    # index d holds the weight of degree d (index 0 is unused)
+    rho = [0.0, 1.0 / k] + [1.0 / (d * (d - 1)) for d in range(2, k + 1)]
+    r = SOLITON_C * math.log(k / SOLITON_DELTA) * math.sqrt(k)
+    spike = max(1, min(k, int(round(k / r))))
+    tau = [0.0] * (k + 1)
+    for d in range(1, spike):
+        tau[d] = r / (d * k)
+    tau[spike] = r * math.log(r / SOLITON_DELTA) / k
+    return [max(0.0, p + t) for p, t in zip(rho, tau)]
+
+
+soliton_tables = {}
+
+
+def soliton_degree(k, upper):
+    # degree for a system mixing from k mids, at most upper
+    key = (k, upper)
+    if key not in soliton_tables:
+        weights = robust_soliton(k)[1:upper + 1]
+        soliton_tables[key] = AliasTable(weights)
+    return 1 + soliton_tables[key].sample()
+
+
 def make_data(data):
     footer = struct.pack("<B", TYPE_DATA)
     return data + footer
 
 
-def make_ack(last_seen_remote_mid, oldest_local_mid):
+def make_zdata(data):
+    footer = struct.pack("<B", TYPE_ZDATA)
+    return data + footer
+
+
+def make_ack(last_seen_remote_mid, oldest_local_mid, size=None,
+             features=0, profile=None, report=None):
+    # size is the one of the whole transmission
+    profile = PROFILE if profile is None else profile
     header = struct.pack("<HH", last_seen_remote_mid, oldest_local_mid)
+    if report is not None:
+        features |= FEATURE_TUNE
+    if features:
+        header += struct.pack("<BB", ACK_MAGIC, features) + ACK_CHECK
+    if features & FEATURE_TUNE:
+        header += struct.pack(REPORT_FORMAT, *report)
     footer = struct.pack("<B", TYPE_ACK)
-    size = max_size() - OVERHEAD - 4
+    if size is None:
+        size = profile.max_size()
+    size -= profile.overhead + len(header)
     # helps dedup requests, helps with to_address failure
     pad = random.getrandbits(size * 8)
     as_bytes = pad.to_bytes(size, byteorder='little')
@@ -234,14 +631,196 @@ def parse_ack(payload):
     return struct.unpack_from("<HH", payload)
 
 
+def ack_features(payload):
+    # the footer follows, at least
+    if len(payload) <= 6 or payload[4] != ACK_MAGIC:
+        return 0
+    if payload[6:6 + len(ACK_CHECK)] != ACK_CHECK:
+        # random padding, or an ack from before ACK_CHECK
+        return 0
+    return payload[5]
+
+
+def ack_report(payload):
+    # (heard, stalled, loss) when the ack has one, see Tuner
+    if not ack_features(payload) & FEATURE_TUNE:
+        return None
+    offset = 6 + len(ACK_CHECK)
+    if len(payload) < offset + REPORT_SIZE + 1:
+        return None
+    return struct.unpack_from(REPORT_FORMAT, payload, offset)
+
+
 def parse_data(payload):
     return payload[:-1]
 
 
+def make_transmission(chid, mids, payload_bytes, ack=None, missing=None):
+    return PROFILE.make_transmission(chid, mids, payload_bytes, ack, missing)
+
+
+# one tunnel: a section of config.ini (DEFAULT is PROFILE, the others go in
+# PROFILES too, see find_profile), with what derives from it computed once.
+# Scoreboard, Systems, System and Backlog take one, PROFILE when not told.
+class TunnelProfile:
+    def __init__(self, config=None, name='DEFAULT', **overrides):
+        config = dict(CONFIG if config is None else config, **overrides)
+        self.config = config
+        self.name = name
+        self.domain = config['domain']
+        self.tail = self.domain.encode('ascii')
+        self.suffix = b'.' + self.tail.lower()
+        self.n = config['n']
+        self.reset = config['reset']
+        self.ackperiod = config['ackperiod']
+        self.window = config['window']
+        self.codec = config.get('codec', 'base64')
+        self.strategy = config.get('strategy', 'classic')
+        self.compression = config.get('compress', 'none')
+        self.downstream = config.get('downstream', 'cname')
+        self.endpoint = config.get('endpoint')  # port the server connects to
+        self.mux = bool(config.get('mux', 0))  # streams in frames, see Mux
+        self.longpoll = config.get('longpoll', 0)  # see POLL_CHECK
+        self.tune = bool(config.get('tune', 0))  # see Tuner
+        # for testing purposes
+        self.tiny = config.get('_tiny')
+        self.fickle = config.get('_fickle')
+        assert(self.window > self.ackperiod)
+        assert(self.n % 2 == 1)
+        assert(self.reset <= PIGGYBACK_ESCAPE)
+
+        self.overhead = overhead(self.n)
+        self.half = (self.reset - 1) // 2  # offsets past this are in the past
+        chars = body_chars(self.domain)
+        self.sizes = {name: codec.capacity(chars) if self.tiny is None
+                      else self.tiny for name, codec in CODECS.items()}
+        self.mids = struct.Struct("<%dH" % self.n)
+        self.mids_size = self.mids.size
+        self.padding = (0,) * self.n
+
+    def max_size(self, codec=None):
+        return self.sizes[self.codec if codec is None else codec]
+
+    def to_address(self, data, codec=None):
+        # None only when data is over max_size(codec)
+        if self.fickle is not None and random.random() < self.fickle:
+            return None
+
+        assert(len(data) > 0)
+        codec = get_codec(self.codec if codec is None else codec)
+
+        if codec.tag is not None:
+            # case insensitive codecs have no '-'
+            body = codec.tag + codec.encode(data)
+        else:
+            std = binascii.b2a_base64(data, newline=False)
+            # what would start the labels after the first one, see SWAP_CHARS
+            starts = std[SUB_NAME_MAX - 1::SUB_NAME_MAX]
+            swap = None
+            marker = b'_'
+            if b'+' in starts:
+                swap = next(c for c in SWAP_CHARS if c not in starts)
+                marker = bytes([swap])
+            body = marker + std.translate(B64_TABLES[swap][0], b'=')
+
+        split = SUB_NAME_MAX
+        full_address = b'.'.join(
+            body[e:(e+split)] for e in range(0, len(body), split)
+        ) + b'.' + self.tail
+        if len(full_address) < NAME_MAX:
+            return full_address
+        return None
+
+    def from_address(self, address):
+        first = address[0].to_bytes(1, byteorder='little')
+        sub = address[1:-len(self.suffix)]
+
+        if first in CODEC_TAGS:
+            return CODEC_TAGS[first].decode(sub.translate(None, b'.'))
+
+        swap = None if first == b'_' else first[0]
+        std = sub.translate(B64_TABLES[swap][1], b'.')
+        return binascii.a2b_base64(std + b'=' * (-len(std) % 4))
+
+    def distances(self, x, y):
+        min_ = min(x, y)
+        max_ = max(x, y)
+        direct = max_ - min_
+        circular = self.reset - max_ + min_
+        return (direct, circular)
+
+    def compare(self, x, y):
+        # old school cmp like function
+        if x == y:
+            return 0
+
+        direct, circular = self.distances(x, y)
+
+        if circular < direct:
+            # it is likely we wrapped
+            if x < y:
+                # x is close to 0, y close to the end
+                # so x is greater than y
+                return 1
+            else:
+                return -1
+        else:
+            if x < y:
+                # x and y are in the middle of the buffer,
+                # classic order applies
+                return -1
+            else:
+                return 1
+
+    def successor(self, mid, n=1):
+        # dont use 0, or end
+        return 1 + (mid + n - 1) % (self.reset - 1)
+
+    def offset(self, base, mid):
+        # how far after base mid lives, 0 for successor(base)
+        return (mid - base - 1) % (self.reset - 1)
+
+    def make_transmission(self, chid, mids, payload_bytes, ack=None,
+                          missing=None):
+        # ack is (last seen remote mid, oldest local mid) to piggyback,
+        # missing the bitmap that may go with it
+        assert(self.n >= len(mids))
+        header = struct.pack(CHID_FORMAT, chid)
+        if ack is not None:
+            header += struct.pack(PIGGYBACK_FORMAT, PIGGYBACK_ESCAPE, *ack)
+            if missing is not None:
+                header += struct.pack(SACK_FORMAT, PIGGYBACK_ESCAPE, missing)
+        header += self.mids.pack(*mids, *self.padding[len(mids):])
+        # size is checked by to_address, with the codec in use
+        return header + payload_bytes
+
+
+PROFILE = TunnelProfile()
+OVERHEAD = PROFILE.overhead
+PROFILES = [PROFILE] + [TunnelProfile(section(name), name)
+                        for name in parsed.sections()]
+
+
+def find_profile(name, profiles=PROFILES):
+    # the one whose domain name ends with, resolvers may randomize its case;
+    # the longest one when domains nest
+    found = None
+    for profile in profiles:
+        if name[-len(profile.suffix):].lower() != profile.suffix:
+            continue
+        if found is None or len(profile.suffix) > len(found.suffix):
+            found = profile
+    return found
+
+
 class System:
-    def __init__(self):
+    def __init__(self, profile=None):
+        self.profile = PROFILE if profile is None else profile
         self.mids = []
         self.payload = 0
+        self.ack = None  # piggybacked, see make_transmission
+        self.missing = None
+        self.poll = False  # see POLL_CHECK
 
     def mix(self, mid, data):
         self.mids.append(mid)
@@ -249,190 +828,681 @@ class System:
         return self
 
     def to_transmission(self, chid):
-        n = CONFIG['n']
-        assert(n >= len(self.mids))
-        mids = self.mids + (n - len(self.mids)) * [0]
-        header = struct.pack("<B%dH" % n, *([chid] + mids))
         length = (self.payload.bit_length() + 7) // 8
-        assert(length <= max_size())
         payload_bytes = self.payload.to_bytes(length, byteorder='little')
-        return header + payload_bytes
+        return self.profile.make_transmission(chid, self.mids, payload_bytes)
 
-    def to_address(self, chid):
+    def to_address(self, chid, codec=None):
         transmission = self.to_transmission(chid)
-        address = to_address(transmission)
+        address = self.profile.to_address(transmission, codec)
         return address
 
     def from_transmission(self, transmission):
-        n = CONFIG['n']
-        chid, *self.mids = struct.unpack_from("<B%dH" % n, transmission)
+        offset = CHID_SIZE
+        if struct.unpack_from("<H", transmission, offset)[0] == PIGGYBACK_ESCAPE:
+            _, *ack = struct.unpack_from(PIGGYBACK_FORMAT, transmission, offset)
+            self.ack = tuple(ack)
+            offset += PIGGYBACK_SIZE
+            if struct.unpack_from("<H", transmission, offset)[0] == PIGGYBACK_ESCAPE:
+                _, self.missing = struct.unpack_from(
+                    SACK_FORMAT, transmission, offset)
+                offset += SACK_SIZE
+        self.mids = self.profile.mids.unpack_from(transmission, offset)
         self.mids = tuple(x for x in self.mids if x != 0)
-        self.payload = int.from_bytes(
-            transmission[(2 * n + 1):], byteorder='little')
+        payload = transmission[(offset + self.profile.mids_size):]
+        self.payload = int.from_bytes(payload, byteorder='little')
+        self.poll = len(self.mids) == 0 and payload.startswith(POLL_CHECK)
         return self
 
 
-class Systems:
+numpy = None  # see load_numpy()
+numpy_loaded = False
+
+
+def load_numpy():
+    # numpy takes a while to import and only Encoder uses it, the first
+    # one imports it; without numpy Encoder falls back to python ints
+    global numpy, numpy_loaded
+    if not numpy_loaded:
+        numpy_loaded = True
+        try:
+            import numpy
+        except ImportError:
+            pass
+    return numpy
+
+
+class Encoder:
+    # backlog lines as rows of a fixed width uint8 matrix, zero padded on the
+    # high end, so a whole batch of systems is mixed in one numpy call;
+    # without numpy rows are python ints, converted once on the way in
     def __init__(self):
-        self.systems = {}
+        load_numpy()
+        self.width = 0
+        self.slots = {}  # mid -> row index
+        self.free = []
+        # row 0 stays zero, it pads selections shorter than n
+        if numpy is not None:
+            self.rows = numpy.zeros((1, 0), dtype=numpy.uint8)
+        else:
+            self.rows = [0]
+
+    def _grow(self, height, width):
+        width = max(width, self.width)
+        if numpy is not None:
+            rows = numpy.zeros((height, width), dtype=numpy.uint8)
+            rows[:len(self.rows), :self.width] = self.rows
+            self.rows = rows
+        else:
+            self.rows += [0] * (height - len(self.rows))
+        self.width = width
+
+    def add(self, mid, line):
+        if len(self.free) > 0:
+            slot = self.free.pop()
+        else:
+            slot = len(self.rows)
+            self._grow(2 * slot, len(line))
+            self.free = list(range(2 * slot - 1, slot, -1))
+
+        if len(line) > self.width:
+            self._grow(len(self.rows), len(line))
+
+        if numpy is not None:
+            self.rows[slot, :] = 0
+            self.rows[slot, :len(line)] = numpy.frombuffer(line, numpy.uint8)
+        else:
+            self.rows[slot] = int.from_bytes(line, byteorder='little')
+        self.slots[mid] = slot
+
+    def remove(self, mid):
+        self.free.append(self.slots.pop(mid))
+
+    def mix(self, selections):
+        # xor of the lines of each selection, trailing zeros removed,
+        # exactly what System.to_transmission would send
+        if len(selections) == 0:
+            return []
+
+        if numpy is None:
+            mixed = []
+            for selection in selections:
+                payload = 0
+                for mid in selection:
+                    payload ^= self.rows[self.slots[mid]]
+                length = (payload.bit_length() + 7) // 8
+                mixed.append(payload.to_bytes(length, byteorder='little'))
+            return mixed
+
+        depth = max(len(s) for s in selections)
+        index = numpy.zeros((len(selections), depth), dtype=numpy.intp)
+        for i, selection in enumerate(selections):
+            index[i, :len(selection)] = [self.slots[m] for m in selection]
+        payloads = numpy.bitwise_xor.reduce(self.rows[index], axis=1)
+        return [p.tobytes().rstrip(b'\0') for p in payloads]
+
+
+# incoming systems are kept as a reduced row echelon matrix over GF(2):
+# a row is a bitmask of mids (bit i stands for offset(anchor, mid) == i)
+# and the xor of their payloads, rows are keyed by their pivot, i.e. their
+# lowest bit, no row has a bit set in another row's pivot column.
+SYSTEMS_MAX_ROWS = 1024
+
+
+class Systems:
+    def __init__(self, max_rows=SYSTEMS_MAX_ROWS, profile=None):
+        self.profile = PROFILE if profile is None else profile
+        self.max_rows = max_rows
+        self.systems = {}  # pivot -> (mask, payload)
+        self.pivots = 0  # bitmask of the pivot columns
+        self.columns = 0  # bitmask of the columns transmissions touched
+        self.anchor = INVALID_MID  # bit 0 is successor(anchor)
         self.oldest_remote_mid = INVALID_MID
         self.last_seen_remote_mid = INVALID_MID
         self.tries = 0
         self.acks = []
         self.data = []
+        self.codec = None  # codec of the last name we got
+        self.features = 0  # what the remote told us it understands
+        self.received = 0  # bytes of data extracted
+        self.stale = 0  # stale transmissions in a row
+        self.piggybacking = False  # the remote acks in its headers
+        self.sack = None  # freshest (last seen, missing) of the remote
+        self.polled = False  # the last transmission was a poll
+        self.heard = 0  # transmissions, for the reports, see Tuner
+        self.stalled = 0
+        self.reports = []  # the remote's, see Tuner
+        self.inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _eliminate(self, mask, payload):
+        # rows are fully reduced, xoring one in only clears its own pivot
+        hits = mask & self.pivots
+        while hits:
+            low = hits & -hits
+            row_mask, row_payload = self.systems[low.bit_length() - 1]
+            mask ^= row_mask
+            payload ^= row_payload
+            hits ^= low
+
+        if mask == 0:
+            # nothing we did not know already
+            return
+
+        bit = mask & -mask
+        pivot = bit.bit_length() - 1
+        # keep the matrix reduced, rows with a lower pivot never see this one
+        for p, (row_mask, row_payload) in self.systems.items():
+            if row_mask & bit:
+                self.systems[p] = (row_mask ^ mask, row_payload ^ payload)
 
-    def _simplify(self, step):
-        news = {}
-        to_del = set()
-        for s in step:
-            set_s = set(s)
-            len_s = len(s)
-            for t in self.systems:
-                c = set_s.symmetric_difference(t)
-                len_c = len(c)
-                if len_c > 0 and len_c < len_s:
-                    new = tuple(c)
-                    if new not in self.systems:
-                        payload_s = self.systems[s]
-                        payload_t = self.systems[t]
-                        news[new] = payload_s ^ payload_t
-
-                    # c and s are equivalent anyway, remove
-                    # the most complex
-                    to_del.add(s)
-
-        for n in news:
-            self.systems[n] = news[n]
-
-        for s in to_del:
-            del self.systems[s]
-
-        if len(news) > 0:
-            self._simplify(news)
+        self.systems[pivot] = (mask, payload)
+        self.pivots |= bit
+
+        if len(self.systems) > self.max_rows:
+            # the newest mids are the least useful right now
+            last = max(self.systems)
+            del self.systems[last]
+            self.pivots &= ~(1 << last)
 
     def _extract(self):
-        target_mid = ring_successor(self.last_seen_remote_mid)
-        key = (target_mid,)
-        if key in self.systems:
-            # looks like the simplify step got us something useable
+        ring = self.profile
+        while True:
+            target_mid = ring.successor(self.last_seen_remote_mid)
+            target = ring.offset(self.anchor, target_mid)
+            row = self.systems.get(target)
+            if row is None or row[0] != 1 << target:
+                self.tries += 1
+                return
+
+            # looks like the elimination got us something useable
             self.tries = 0
-            payload = self.systems[key]
+            METRICS.count('systems.extracted')
+            payload = row[1]
             length = (payload.bit_length() + 7) // 8
             as_bytes = payload.to_bytes(length, byteorder='little')
             type_ = get_type(as_bytes)
-            # removing things for systems is done in trim()
+            # the row stays in, later systems may still mix it, see _trim()
 
             if type_ == TYPE_ACK:
                 ack = parse_ack(as_bytes)
-                self.oldest_remote_mid = ack[1]
-                self.acks.append(ack)
+                # an empty remote backlog means nothing older than
+                # this very ack will be mixed anymore
+                oldest = ack[1] if ack[1] != INVALID_MID else target_mid
+                self._acked(ack, oldest)
+                self.features |= ack_features(as_bytes)
+                report = ack_report(as_bytes)
+                if report is not None:
+                    self.reports.append(report)
             elif type_ == TYPE_DATA:
                 slice_ = parse_data(as_bytes)
                 self.data.append(slice_)
+                self.received += len(slice_)
+            elif type_ == TYPE_ZDATA:
+                # slices come in mid order, the stream is contiguous
+                slice_ = self.inflate.decompress(parse_data(as_bytes))
+                if len(slice_) > 0:
+                    self.data.append(slice_)
+                    self.received += len(slice_)
             else:
                 assert(not "payload is corrupt")
 
             self.updated = True
             self.last_seen_remote_mid = target_mid
-            self._extract()  # do it again
-        else:
-            self.tries += 1
 
-    def _trim(self):
-        if self.oldest_remote_mid == 0:
+    def _acked(self, ack, oldest):
+        self.acks.append(ack)
+        if oldest == INVALID_MID:
+            # the remote had nothing to mix, we cannot tell how far it got
             return
+        # acks may come out of order, the remote's oldest only grows
+        if (self.oldest_remote_mid == INVALID_MID
+                or self.profile.compare(oldest, self.oldest_remote_mid) > 0):
+            self.oldest_remote_mid = oldest
 
-        now = self.oldest_remote_mid
-        def too_old(mid): return ring_compare(mid, now) <= 0
+    def _trim(self):
+        if self.oldest_remote_mid == INVALID_MID:
+            return
 
-        to_trim = set()
-        for mids in self.systems:
-            if any(too_old(mid) for mid in mids):
-                to_trim.add(mids)
+        # the remote does not mix anything older than its oldest mid,
+        # move the anchor right before it
+        ring = self.profile
+        shift = ring.offset(self.anchor, self.oldest_remote_mid)
+        if shift == 0 or shift > ring.half:
+            # nothing to do, or a stale ack
+            return
 
-        for k in to_trim:
-            del self.systems[k]
+        self.systems = {p - shift: (mask >> shift, payload)
+                        for p, (mask, payload) in self.systems.items()
+                        if p >= shift}
+        self.pivots >>= shift
+        self.columns >>= shift
+        self.anchor = ring.successor(self.oldest_remote_mid, -1)
+
+    def missing(self):
+        # bitmap of the mids after last seen no row pivots on, up to the
+        # newest one we heard of: lost, or mixed with other missing ones
+        ring = self.profile
+        first = ring.offset(self.anchor,
+                            ring.successor(self.last_seen_remote_mid))
+        heard = (1 << self.columns.bit_length()) - 1
+        return (heard & ~self.pivots) >> first & ((1 << SACK_BITS) - 1)
 
     # push data in
     def add(self, name):
-        transmission = from_address(name)
-        system = System().from_transmission(transmission)
-        self.systems[system.mids] = system.payload
-
-        self._simplify([system.mids])
+        self.codec = address_codec(name)
+        self.add_transmission(self.profile.from_address(name))
+
+    # or straight from a packed answer, see to_records
+    def add_transmission(self, transmission):
+        ring = self.profile
+        system = System(ring).from_transmission(transmission)
+        METRICS.count('systems.transmissions')
+        self.polled = system.poll
+        if len(system.mids) > 0:
+            self.heard = (self.heard + 1) & 0xffff
+
+        mask = 0
+        for mid in system.mids:
+            offset = ring.offset(self.anchor, mid)
+            if offset > ring.half:
+                # older than anything the remote still mixes
+                METRICS.count('systems.stale')
+                self.stale += 1
+                return
+            mask ^= 1 << offset
+        if len(system.mids) > 0:
+            self.stale = 0
+
+        if system.ack is not None:
+            METRICS.count('systems.piggybacked')
+            # reading our acks there is as good as the feature bit
+            self.piggybacking = True
+            self.features |= FEATURE_PIGGYBACK
+            self._acked(system.ack, system.ack[1])
+
+        if system.missing is not None:
+            self.features |= FEATURE_SACK
+            last_seen = system.ack[0]
+            if self.sack is None or ring.compare(last_seen, self.sack[0]) >= 0:
+                self.sack = (last_seen, system.missing)
+
+        self.columns |= mask
+        self._eliminate(mask, system.payload)
         self._extract()
         self._trim()
+        if mask and self.tries >= TUNE_STALL and self.missing():
+            # mids we heard of, still out of reach
+            self.stalled = (self.stalled + 1) & 0xffff
 
     # when done querying data out
     def commit(self):
         self.data = []
         self.acks = []
+        self.sack = None
+        self.reports = []
+
+
+class Backlog:
+    # lines waiting for the remote's ack; mids come from allocate_mid(),
+    # so appending keeps them in ring order, the oldest on the left
+    def __init__(self, profile=None):
+        self.profile = PROFILE if profile is None else profile
+        self.lines = {}
+        self.order = collections.deque()
+        self.pending = 0  # lines that are not acks
+
+    def __setitem__(self, mid, line):
+        assert(mid not in self.lines)
+        self.lines[mid] = line
+        self.order.append(mid)
+        if get_type(line) != TYPE_ACK:
+            self.pending += 1
+
+    def __getitem__(self, mid):
+        return self.lines[mid]
+
+    def __contains__(self, mid):
+        return mid in self.lines
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def values(self):
+        return (self.lines[mid] for mid in self.order)
+
+    def oldest(self):
+        return self.order[0] if len(self.order) > 0 else INVALID_MID
+
+    def head(self, count):
+        return list(itertools.islice(self.order, count))
+
+    def retire(self, last_seen):
+        # drop everything up to last_seen, only touches what goes away
+        retired = []
+        compare = self.profile.compare
+        while len(self.order) > 0 and compare(self.order[0], last_seen) <= 0:
+            mid = self.order.popleft()
+            if get_type(self.lines.pop(mid)) != TYPE_ACK:
+                self.pending -= 1
+            retired.append(mid)
+        return retired
+
+
+SENT_MAX = 4096  # selections a Scoreboard remembers
+
+
+class SentHistory:
+    # selections already sent, least recently used first, with an index
+    # from each mid to the selections holding it so retiring is cheap
+    def __init__(self, limit=SENT_MAX):
+        self.limit = limit
+        self.entries = collections.OrderedDict()  # selection -> None
+        self.index = {}  # mid -> set of selections
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, selection):
+        self.lookups += 1
+        if selection not in self.entries:
+            return False
+        self.hits += 1
+        self.entries.move_to_end(selection)
+        return True
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def add(self, selection):
+        if selection in self.entries:
+            self.entries.move_to_end(selection)
+            return
+
+        self.entries[selection] = None
+        for mid in selection:
+            self.index.setdefault(mid, set()).add(selection)
+
+        while len(self.entries) > self.limit:
+            oldest, _ = self.entries.popitem(last=False)
+            self._unindex(oldest)
+
+    def _unindex(self, selection):
+        for mid in selection:
+            holders = self.index.get(mid)
+            if holders is not None:
+                holders.discard(selection)
+                if len(holders) == 0:
+                    del self.index[mid]
+
+    def retire(self, mid):
+        # remote knows mid, what is left of a selection is as good as sent
+        for selection in self.index.pop(mid, ()):
+            del self.entries[selection]
+            self._unindex(selection)
+            rest = tuple(m for m in selection if m != mid)
+            if len(rest) > 0:
+                self.add(rest)
+
+
+# with TUNE = 1, an end picks how many mids go in a system (under N, a
+# narrow mix decodes at once, a wide one rides out losses) from the loss,
+# and grows its window while the remote keeps up decoding, halving it on
+# stalls. Only the client sees losses, as queries without answers, taken
+# as the same loss on both legs. Every TUNE_EPOCH transmissions it heard,
+# an end tells the remote in a standalone ack its loss estimate, if any,
+# and how many of those transmissions left decoding stuck: TUNE_STALL
+# tries or more with mids missing. The decoder takes whatever comes,
+# there is nothing else to agree on.
+TUNE_EPOCH = 16
+TUNE_STALL = 8
+TUNE_GAIN = 1 / 32  # of a query in the loss estimate
+TUNE_UNKNOWN = 0xffff  # loss in a report, when the end cannot tell
+TUNE_WIDTHS = ((0.08, 1), (0.18, 3))  # below that loss, that width, else N
+TUNE_STALLS = 0.1  # of the transmissions heard, more halves the window
+TUNE_WINDOW_MAX = 4  # times WINDOW
+
+
+class Tuner:
+    def __init__(self, profile=None):
+        self.profile = PROFILE if profile is None else profile
+        self.width = self.profile.n
+        self.window = self.profile.window
+        self.ackperiod = self.profile.ackperiod
+        self.loss = None  # one way, until we measure it or hear about it
+        self.unanswered = None  # of our queries, when we send some
+        self.last = None  # (heard, stalled) of the last report
+        self.counters = collections.Counter()
+
+    def sample(self, lost):
+        # a query went out, and came back or not
+        if not self.profile.tune:
+            return
+        if self.unanswered is None:
+            self.unanswered = 0.0
+        self.unanswered += TUNE_GAIN * (lost - self.unanswered)
+        self.loss = 1 - math.sqrt(1 - self.unanswered)
+        self.retune()
+
+    def update(self, report):
+        # the remote's (heard, stalled, loss), see Scoreboard.tune()
+        heard, stalled, loss = report
+        self.counters['reports'] += 1
+        if self.unanswered is None and loss != TUNE_UNKNOWN:
+            self.loss = loss / TUNE_UNKNOWN
+        last, self.last = self.last, (heard, stalled)
+        if last is not None:
+            heard = (heard - last[0]) & 0xffff
+            stalled = (stalled - last[1]) & 0xffff
+            if stalled > TUNE_STALLS * heard:
+                self.window = max(self.profile.window, self.window // 2)
+                self.counters['stalls'] += 1
+            else:
+                self.window = min(TUNE_WINDOW_MAX * self.profile.window,
+                                  self.window + 1)
+        self.retune()
+
+    def retune(self):
+        profile = self.profile
+        loss = 0.0 if self.loss is None else self.loss
+        self.width = profile.n
+        for below, width in TUNE_WIDTHS:
+            if loss < below:
+                self.width = min(width, profile.n)
+                break
+        # acks (before both ends piggyback) come sooner the more get lost
+        self.ackperiod = max(1, min(self.window - 1,
+                                    round(profile.ackperiod * (1 - loss))))
+
+    def report(self):
+        # our loss estimate, for the remote
+        if self.unanswered is None:
+            return TUNE_UNKNOWN
+        return min(TUNE_UNKNOWN - 1, round(self.loss * TUNE_UNKNOWN))
+
+    def state(self):
+        state = dict(self.counters)
+        state.update(width=self.width, window=self.window,
+                     ackperiod=self.ackperiod, loss=self.loss or 0.0)
+        return state
 
 
 class Scoreboard:
-    def __init__(self):
+    def __init__(self, sent_limit=SENT_MAX, profile=None):
+        self.profile = PROFILE if profile is None else profile
         self.chid = generate_channel_id()
         self.mid = INVALID_MID
         self.last_seen_remote_mid = INVALID_MID
-        self.backlog = {}
-        self.sent = set()
+        self.backlog = Backlog(self.profile)
+        self.encoder = Encoder()
+        self.sent = SentHistory(sent_limit)
+        self.coverage = {}  # mid -> times it went into a system
+        self.strategy = self.profile.strategy
+        self.codec = self.profile.codec  # chosen once per session
+        self.size = None  # transmissions go in names, see capacity()
+        # data is deflated once the remote says it can inflate, see
+        # start_compression(); it goes out at the next flush()
+        self.compression = self.profile.compression
+        self.features = FEATURE_PIGGYBACK | FEATURE_SACK
+        if self.compression == 'zlib':
+            self.features |= FEATURE_ZLIB
+        self.deflate = None
+        self.piggyback = False  # see start_piggyback()
+        self.sack = False  # the remote reads FEATURE_SACK headers
+        # what we tell the remote it misses, see Systems.missing(), and the
+        # local mids it told us it misses, see steer()
+        self.missing_remote_mids = 0
+        self.missing = []
+        self.reported = set()
+        self.steered = (INVALID_MID, {})  # mid -> reports since, per last seen
+        self.unflushed = False
+        self.counters = collections.Counter()
+        self.pushed_at = {}  # mid -> time.monotonic(), with METRICS on
+        self.tuner = Tuner(self.profile)
+        self.report_at = 0  # Systems.heard at our last report
+        self.opening = False  # see select_opening()
 
     def allocate_mid(self):
-        next_mid = ring_successor(self.mid)
+        next_mid = self.profile.successor(self.mid)
         assert(next_mid not in self.backlog)
         self.mid = next_mid
         return next_mid
 
     def oldest_local_mid(self):
-        oldest_local_mid = INVALID_MID
-        for mid in self.backlog:
-            if oldest_local_mid == INVALID_MID or ring_compare(mid, oldest_local_mid) <= 0:
-                oldest_local_mid = mid
-
-        return oldest_local_mid
+        return self.backlog.oldest()
+
+    def empty(self):
+        # nothing but acks to send
+        return self.backlog.pending == 0
+
+    def capacity(self):
+        # largest transmission we can send
+        if self.size is None:
+            return self.profile.max_size(self.codec)
+        return self.size
+
+    def start_compression(self):
+        if self.compression == 'zlib' and self.deflate is None:
+            self.deflate = zlib.compressobj(
+                COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def start_piggyback(self, features=0):
+        # the remote reads acks in our transmission headers, and the
+        # missing mids bitmap with FEATURE_SACK
+        self.piggyback = True
+        self.sack = bool(features & FEATURE_SACK)
+
+    def steer(self, last_seen, bitmap):
+        # the remote cannot go past last_seen without these, the next
+        # systems lead with one each, see select_missing(); reports lag,
+        # while the remote stays put a mid is steered every STEER_AGAIN
+        successor = self.profile.successor
+        mids = [successor(last_seen, i + 1) for i in range(SACK_BITS)
+                if bitmap >> i & 1]
+        if self.steered[0] != last_seen:
+            self.steered = (last_seen, {})
+        steered = self.steered[1]
+        for m in steered:
+            steered[m] += 1
+        self.missing = [m for m in mids if m in self.backlog
+                        and steered.get(m, STEER_AGAIN) >= STEER_AGAIN]
+        steered.update((m, 0) for m in self.missing)
+        self.reported = set(mids)
+
+    def compression_ratio(self):
+        # compressed over raw bytes, since start_compression()
+        if self.counters['raw'] == 0:
+            return 1.0
+        return self.counters['compressed'] / self.counters['raw']
 
     def push_data(self, data):
-        size = max_size() - OVERHEAD
+        self.counters['pushed'] += len(data)
+        METRICS.count('scoreboard.bytes', len(data))
+        if self.deflate is not None:
+            self.counters['raw'] += len(data)
+            self._push_slices(self.deflate.compress(data), make_zdata)
+            self.unflushed = True
+        else:
+            self._push_slices(data, make_data)
+
+    def flush(self):
+        # sync flush, call when about to transmit
+        if self.unflushed:
+            self._push_slices(self.deflate.flush(zlib.Z_SYNC_FLUSH), make_zdata)
+            self.unflushed = False
+
+    def _push_slices(self, data, make):
+        if make is make_zdata:
+            self.counters['compressed'] += len(data)
+        size = self.capacity() - self.profile.overhead
         for start in range(0, len(data), size):
             slice_ = data[start:start+size]
             mid = self.allocate_mid()
-            self.backlog[mid] = make_data(slice_)
+            self.backlog[mid] = make(slice_)
+            self.encoder.add(mid, self.backlog[mid])
+            if METRICS.enabled:
+                self.pushed_at[mid] = time.monotonic()
 
-    def push_ack(self, last_seen_remote_mid=INVALID_MID):
+    def push_ack(self, last_seen_remote_mid=INVALID_MID, report=None):
         mid = self.allocate_mid()
         if last_seen_remote_mid != INVALID_MID:
             # transmit() needs to generate an ack from thin air
             # when backlog is empty
             self.last_seen_remote_mid = last_seen_remote_mid
-        self.backlog[mid] = make_ack(
-            self.last_seen_remote_mid, self.oldest_local_mid())
+        # padding dedups names, packed answers have no use for it
+        if self.size is None:
+            size = self.profile.max_size(self.codec)
+        else:
+            size = self.profile.overhead + 4 + (
+                2 + len(ACK_CHECK) if self.features else 0) + (
+                REPORT_SIZE if report is not None else 0)
+        self.backlog[mid] = make_ack(self.last_seen_remote_mid,
+                                     self.oldest_local_mid(), size,
+                                     self.features, self.profile, report)
+        self.encoder.add(mid, self.backlog[mid])
+        METRICS.count('scoreboard.acks')
+
+    def tune(self, systems):
+        # with TUNE, the remote's reports go to the tuner and ours out
+        # every TUNE_EPOCH transmissions, call before systems.commit()
+        if not self.profile.tune:
+            return
+        for report in systems.reports:
+            self.tuner.update(report)
+        systems.reports = []
+        size = self.profile.overhead + 4 + 2 + len(ACK_CHECK) + REPORT_SIZE
+        if size > self.capacity():
+            return  # names too short for a report, the remote tunes alone
+        if (systems.heard - self.report_at) & 0xffff >= TUNE_EPOCH:
+            self.report_at = systems.heard
+            self.push_ack(report=(systems.heard, systems.stalled,
+                                  self.tuner.report()))
+            METRICS.count('scoreboard.reports')
 
     def retire(self, remote_last_seen_remote_mid):
         # remote_last_seen_remote_mid is a local number!
-        to_retire = set()
-        for mid in self.backlog:
-            if ring_compare(mid, remote_last_seen_remote_mid) <= 0:
-                # mid is older, i.e. already seen by remote
-                to_retire.add(mid)
-
-        for mid in to_retire:
-            del self.backlog[mid]
+        # older mids were already seen by remote
+        if self.profile.compare(remote_last_seen_remote_mid, self.mid) > 0:
+            # about mids we never sent, not our remote
+            return
+        for mid in self.backlog.retire(remote_last_seen_remote_mid):
+            self.encoder.remove(mid)
+            self.coverage.pop(mid, None)
+            pushed_at = self.pushed_at.pop(mid, None)
+            if pushed_at is not None:
+                METRICS.observe('scoreboard.push_to_retire',
+                                time.monotonic() - pushed_at)
 
             # also cleanup the history of sent composite systems,
             # see select_system
-            def remove_mid(mids): return tuple(m for m in mids if m != mid)
-            self.sent = {remove_mid(s) for s in self.sent}
-
-    def mix_system(self, selection):
-        system = System()
-        for mid in selection:
-            system.mix(mid, self.backlog[mid])
-
-        return system.to_address(self.chid)
+            self.sent.retire(mid)
 
     def random_sample(self, source, tries):
-        n = CONFIG['n']
-        max_count = min(len(source), n)
+        max_count = min(len(source), self.tuner.width)
         for _ in range(tries):
             # we like odd, small, >0; we made random_count
             # live in [0,n] biased toward even, so +1
@@ -446,18 +1516,99 @@ class Scoreboard:
         return None
 
     def select_system(self):
-        batch = CONFIG['window']
-        oldest = self.oldest_local_mid()
+        strategies = {
+            'classic': self.select_classic,
+            'soliton': self.select_soliton,
+        }
+        opening = (self.opening
+                   and self.profile.successor(INVALID_MID) in self.backlog)
+        if len(self.missing) > 0:
+            selection = self.select_missing()
+        elif opening:
+            selection = self.select_opening()
+        else:
+            selection = strategies[self.strategy]()
+        for mid in selection:
+            seen = self.coverage.get(mid, 0)
+            if seen > 0:
+                METRICS.count('scoreboard.remixed')
+            self.coverage[mid] = seen + 1
+        METRICS.count('scoreboard.mixed', len(selection))
+        return selection
+
+    def select_soliton(self):
+        # LT style: robust soliton degree, seeded with the mid the remote has
+        # been offered the least (oldest first), the rest is uniform
+        mids = self.backlog.head(self.tuner.window)
+        upper = min(len(mids), self.tuner.width)
+
+        def by_need(m): return self.coverage.get(m, 0)
+        first = min(mids, key=by_need)
+        others = [m for m in mids if m != first]
+        degree = soliton_degree(len(mids), upper)
+        selection = (first,) + tuple(random.sample(others, degree - 1))
+
+        # no rejection sampling, grow or rotate what we have when it
+        # was sent already (same content, different system header)
+        for _ in range(upper):
+            if selection not in self.sent:
+                self.sent.add(selection)
+                return selection
+            unused = [m for m in others if m not in selection]
+            if len(selection) < upper and len(unused) > 0:
+                selection += (random.choice(unused),)
+            else:
+                selection = selection[1:] + selection[:1]
+
+        # everything is known to the remote, try stiring things up
+        stirred = self.stir(mids)
+        if stirred is not None:
+            return stirred
+        selection = (self.mid,)
+        self.sent.add(selection)
+        return selection
+
+    def select_missing(self):
+        # the remote has pivots for the others, whatever they are mixed
+        # with it is left with the missing mid
+        mid = self.missing.pop(0)
+        others = [m for m in self.backlog.head(self.tuner.window)
+                  if m not in self.reported]
+        count = random_count(min(len(others), self.tuner.width - 1))
+        selection = (mid,) + tuple(random.sample(others, count))
+        self.sent.add(selection)
+        METRICS.count('scoreboard.steered')
+        return selection
+
+    def select_opening(self):
+        # until the client hears from the server, its channel may be new
+        # there: every system has our first mid, see opens_channel()
+        TRY_SAMPLE = 10
+        first = self.profile.successor(INVALID_MID)
+        for _ in range(2):
+            others = [m for m in self.backlog.head(self.tuner.window)
+                      if m != first]
+            upper = min(len(others), self.tuner.width - 1)
+            for _ in range(TRY_SAMPLE):
+                count = random_count(upper)
+                selection = (first,) + tuple(random.sample(others, count))
+                if selection not in self.sent:
+                    self.sent.add(selection)
+                    return selection
+            # a new ack makes for new systems
+            self.push_ack()
+        return selection
+
+    def select_classic(self):
+        batch = self.tuner.window
         TRY_INJECT_ACK = 3
         TRY_SAMPLE_BATCH = 50
         TRY_SAMPLE_FULL = 10
 
         for _ in range(TRY_INJECT_ACK):
-            def by_age(m): return ring_difference(m, oldest)
-            mids = sorted(self.backlog, key=by_age)
-
-            # first try sending things in first batch
-            first = mids[:batch]
+            # first try sending things in first batch,
+            # the backlog is already sorted by age
+            first = self.backlog.head(batch)
             sampled = self.random_sample(first, TRY_SAMPLE_BATCH)
             if sampled is not None:
                 return sampled
@@ -465,29 +1616,1121 @@ class Scoreboard:
             # when we found nothing useful in the batch setup,
             # send systems from the full gamut, we want to delay
             # inserting acks
+            mids = list(self.backlog)
             sampled = self.random_sample(mids, TRY_SAMPLE_FULL)
             if sampled is not None:
                 return sampled
 
             # we failed at making a system, try stiring things up
+            stirred = self.stir(first)
+            if stirred is not None:
+                return stirred
+
+        # the acks we pushed were never sent, the last one goes alone
+        selection = (self.mid,)
+        self.sent.add(selection)
+        return selection
+
+    def stir(self, mids):
+        # every system we can make out of mids was sent, some got lost
+        if not self.piggyback:
+            # a new ack makes for new systems
+            self.push_ack()
+            return None
+        # acks ride in headers, send a system again rather than a new ack
+        count = 1 + random_count(min(len(mids), self.tuner.width) - 1)
+        selection = tuple(random.sample(mids, count))
+        self.sent.add(selection)
+        METRICS.count('scoreboard.resent')
+        return selection
+
+    def header_ack(self):
+        if not self.piggyback:
+            return None
+        return (self.last_seen_remote_mid, self.oldest_local_mid())
+
+    def header_missing(self):
+        return self.missing_remote_mids if self.sack else None
+
+    def can_poll(self):
+        # what encode_batch() sends next is a header only
+        return len(self.backlog) == 0 and self.piggyback
+
+    def encode_batch(self, count, poll=False):
+        # count transmissions, mixed all at once
+        if len(self.backlog) == 0:
+            if self.piggyback:
+                # the header is the message, a nonce keeps names apart
+                METRICS.count('scoreboard.transmissions', count)
+                marker = POLL_CHECK if poll else b''
+                return [self.profile.make_transmission(
+                    self.chid, (), marker + random.randbytes(4),
+                    self.header_ack(), self.header_missing())
+                    for _ in range(count)]
             self.push_ack()
 
-        assert(not "cannot select a system")
-        return tuple()
-
-    def transmit_system(self):
-        selection = self.select_system()
-        return self.mix_system(selection)
+        selections = [self.select_system() for _ in range(count)]
+        METRICS.count('scoreboard.transmissions', count)
+        payloads = self.encoder.mix(selections)
+        ack, missing = self.header_ack(), self.header_missing()
+        make = self.profile.make_transmission
+        return [make(self.chid, selection, payload, ack, missing)
+                for selection, payload in zip(selections, payloads)]
+
+    def transmit_batch(self, count, poll=False):
+        addresses = []
+        while len(addresses) < count:
+            # sometimes the encoding in to_address fails,
+            # so we might need to try again
+            transmissions = self.encode_batch(count - len(addresses), poll)
+            for transmission in transmissions:
+                address = self.profile.to_address(transmission, self.codec)
+                if address is not None:
+                    addresses.append(address)
+        return addresses
 
     def transmit(self):
-        if len(self.backlog) == 0:
-            self.push_ack()
+        # we make sure there always is a system to send
+        return self.transmit_batch(1)[0]
+
+
+# with MUX = 1 on both ends, one channel carries every local connection:
+# its bytes are frames of u8 kind | u16 stream id | u16 length | payload.
+# The client picks stream ids, OPEN makes the server connect to its
+# endpoint, CLOSE goes either way once the data before it is out. Streams
+# take turns, a slice each, and only so much goes in the Scoreboard at
+# once (a window), so a bulk transfer does not starve an interactive one.
+MUX_FORMAT = "<BHH"
+MUX_HEADER = struct.calcsize(MUX_FORMAT)
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_CLOSE = 3
+MUX_STREAMS_MAX = 0xffff
+
+
+def make_frame(kind, sid, payload=b''):
+    return struct.pack(MUX_FORMAT, kind, sid, len(payload)) + payload
+
+
+class Mux:
+    def __init__(self, score_board):
+        self.score_board = score_board
+        self.pending = collections.OrderedDict()  # sid -> bytearray, turns
+        self.closing = set()  # CLOSE once their data went in
+        self.incoming = b''  # frames straddle slices
+        self.next_sid = 0
+
+    def allocate_sid(self, taken):
+        for _ in range(MUX_STREAMS_MAX):
+            self.next_sid = self.next_sid % MUX_STREAMS_MAX + 1
+            if self.next_sid not in taken:
+                return self.next_sid
+        return None
+
+    def open(self, sid):
+        self.score_board.push_data(make_frame(MUX_OPEN, sid))
+
+    def write(self, sid, data):
+        self.pending.setdefault(sid, bytearray()).extend(data)
+
+    def close(self, sid):
+        if sid in self.pending:
+            self.closing.add(sid)
+        else:
+            self.score_board.push_data(make_frame(MUX_CLOSE, sid))
+
+    def drop(self, sid):
+        # the remote closed it, what is left would go nowhere
+        self.pending.pop(sid, None)
+        self.closing.discard(sid)
+
+    def idle(self):
+        return len(self.pending) == 0
+
+    def buffered(self, sid=None):
+        if sid is not None:
+            return len(self.pending.get(sid, b''))
+        return sum(len(b) for b in self.pending.values())
+
+    def feed(self, lines):
+        # a slice from each stream in turn, until the Scoreboard holds
+        # lines of data (compressed slices only show at flush, hence bytes)
+        score_board = self.score_board
+        size = (score_board.capacity() - score_board.profile.overhead
+                - MUX_HEADER)
+        budget = (lines - score_board.backlog.pending) * size
+        while budget > 0 and len(self.pending) > 0:
+            sid, buffer = self.pending.popitem(last=False)
+            chunk = bytes(buffer[:size])
+            del buffer[:size]
+            score_board.push_data(make_frame(MUX_DATA, sid, chunk))
+            budget -= size
+            if len(buffer) > 0:
+                self.pending[sid] = buffer  # back of the line
+            elif sid in self.closing:
+                self.closing.discard(sid)
+                score_board.push_data(make_frame(MUX_CLOSE, sid))
+
+    def read(self, data):
+        # whole frames out of what the channel delivered, (kind, sid, payload)
+        self.incoming += data
+        frames = []
+        offset = 0
+        while len(self.incoming) - offset >= MUX_HEADER:
+            kind, sid, length = struct.unpack_from(
+                MUX_FORMAT, self.incoming, offset)
+            end = offset + MUX_HEADER + length
+            if end > len(self.incoming):
+                break
+            frames.append((kind, sid, self.incoming[offset + MUX_HEADER:end]))
+            offset = end
+        self.incoming = self.incoming[offset:]
+        return frames
+
+
+# backpressure: past BACKLOG_HIGH data lines waiting for the remote in a
+# Scoreboard, an end stops reading the connection that fills it, and reads
+# again under BACKLOG_LOW (it may overshoot by what one read brings); with
+# MUX, each stream by what waits in its own Mux buffer. A bulk copy would
+# otherwise pile up slices by the thousand: every selection gets slower,
+# and past RESET mids new ones run into those still in the backlog.
+BACKLOG_HIGH = 256
+BACKLOG_LOW = 64
+MUX_BUFFER_HIGH = 64 << 10  # bytes
+MUX_BUFFER_LOW = 16 << 10
+
+
+class Backpressure:
+    # pause and resume are the connection's, in the engine's terms
+    def __init__(self, pause, resume, high=BACKLOG_HIGH, low=BACKLOG_LOW):
+        self.pause = pause
+        self.resume = resume
+        self.high = high
+        self.low = low
+        self.paused = False
+
+    def update(self, level):
+        if not self.paused and level > self.high:
+            self.paused = True
+            self.pause()
+            METRICS.count('backpressure.paused')
+        elif self.paused and level < self.low:
+            self.paused = False
+            self.resume()
+
+
+# query pacing, after rfc 6298 (rtt, rto) and rfc 5681 (aimd window),
+# counting outstanding queries instead of bytes
+RTO_INITIAL = 1.0
+RTO_MIN = 0.2
+RTO_MAX = 20.0
+CWND_INITIAL = 2.0
+CWND_MAX = 64.0
+
+
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTO_INITIAL
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + 4 * self.rttvar
+        self.rto = min(RTO_MAX, max(RTO_MIN, rto))
+
+    def backoff(self):
+        self.rto = min(RTO_MAX, 2 * self.rto)
 
-        best_system = self.transmit_system()
-        if best_system is not None:
-            return best_system
 
-        # we make sure there always is a system to send,
-        # but sometimes the encoding in to_address fails,
-        # so we might need to try again
-        return self.transmit()
+class CongestionControl:
+    # the window only, timeouts are per resolver, see ResolverPool
+    def __init__(self):
+        self.cwnd = CWND_INITIAL
+        self.ssthresh = CWND_MAX
+        self.in_flight = 0
+        self.reduced_at = -math.inf  # cut the window once per round trip
+        self.counters = collections.Counter()
+
+    def window(self):
+        # how many more queries we may send right now
+        return max(0, int(self.cwnd) - self.in_flight)
+
+    def sent(self):
+        self.in_flight += 1
+        self.counters['sent'] += 1
+
+    def answered(self, sent_at, now):
+        self.in_flight -= 1
+        self.counters['answered'] += 1
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1  # slow start
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, CWND_MAX)
+
+    def lost(self, sent_at, now, timeout=True):
+        # timeouts and SERVFAIL alike
+        self.in_flight -= 1
+        self.counters['timeouts' if timeout else 'failures'] += 1
+        if sent_at < self.reduced_at:
+            # sent before the last cut, already accounted for
+            return
+        self.ssthresh = max(self.cwnd / 2, 1.0)
+        self.cwnd = self.ssthresh
+        self.reduced_at = now
+        self.counters['reductions'] += 1
+
+    def state(self):
+        state = dict(self.counters)
+        state.update(cwnd=self.cwnd, ssthresh=self.ssthresh,
+                     in_flight=self.in_flight)
+        return state
+
+
+# upstream resolvers, the client stripes queries across all the healthy ones
+RESOLVER_MAX_IN_FLIGHT = 16
+RESOLVER_DECAY = 0.7  # health is an ewma of answered (1) and lost (0)
+RESOLVER_HEALTH_MIN = 0.3  # below this a resolver is benched
+RESOLVER_SLOW = 4.0  # benched when its srtt is this many times the best one
+RESOLVER_BENCH = 30.0  # seconds before a benched resolver gets another go
+RESOLV_CONF = '/etc/resolv.conf'
+DNS_PORT = 53
+
+
+def parse_resolvers(value):
+    # "1.1.1.1, 9.9.9.9:5353, [2606:4700::1111]:53, 2620:fe::fe"
+    servers = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith('['):
+            host, _, port = item[1:].partition(']')
+            port = port.lstrip(':')
+        elif item.count(':') == 1:
+            host, port = item.split(':')
+        else:
+            host, port = item, ''
+        servers.append((host, int(port) if port else DNS_PORT))
+    return servers
+
+
+def parse_resolv_conf(path=RESOLV_CONF):
+    servers = []
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except OSError:
+        return servers
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'nameserver':
+            servers.append((parts[1], DNS_PORT))
+    return servers
+
+
+def configured_resolvers(path=RESOLV_CONF):
+    servers = parse_resolvers(CONFIG.get('resolvers', ''))
+    servers += parse_resolv_conf(path)
+    return list(dict.fromkeys(servers))  # keep order, drop duplicates
+
+
+class Upstream:
+    def __init__(self, address):
+        self.address = address
+        self.rtt = RttEstimator()
+        self.health = 1.0
+        self.in_flight = 0
+        self.benched_until = -math.inf
+        self.counters = collections.Counter()
+
+    def available(self, now):
+        full = self.in_flight >= RESOLVER_MAX_IN_FLIGHT
+        return not full and now >= self.benched_until
+
+    def score(self):
+        # expected wait for an answer, lower is better; unknown resolvers
+        # look fast so that they get sampled
+        srtt = RTO_MIN if self.rtt.srtt is None else self.rtt.srtt
+        return srtt * (1 + self.in_flight) / self.health
+
+    def bench(self, now):
+        self.benched_until = now + RESOLVER_BENCH
+        self.counters['benched'] += 1
+        # comes back on probation, with a fresh estimate
+        self.health = 2 * RESOLVER_HEALTH_MIN
+        self.rtt = RttEstimator()
+
+
+class ResolverPool:
+    def __init__(self, addresses):
+        addresses = list(dict.fromkeys(addresses))
+        assert(len(addresses) > 0)
+        self.upstreams = [Upstream(a) for a in addresses]
+
+    def pick(self, now):
+        candidates = [u for u in self.upstreams if u.available(now)]
+        if not candidates:
+            # all benched, better a bad resolver than none
+            candidates = [u for u in self.upstreams
+                          if u.in_flight < RESOLVER_MAX_IN_FLIGHT]
+        if not candidates:
+            return None
+        return min(candidates, key=Upstream.score)
+
+    def sent(self, upstream):
+        upstream.in_flight += 1
+        upstream.counters['sent'] += 1
+
+    def answered(self, upstream, sent_at, now, sample=True):
+        upstream.in_flight -= 1
+        upstream.counters['answered'] += 1
+        upstream.health = RESOLVER_DECAY * upstream.health + 1 - RESOLVER_DECAY
+        if not sample:
+            return  # a poll the server held, says nothing of the resolver
+        upstream.rtt.sample(now - sent_at)
+
+        others = [u.rtt.srtt for u in self.upstreams
+                  if u is not upstream and u.rtt.srtt is not None
+                  and u.available(now)]
+        if others and upstream.rtt.srtt > RESOLVER_SLOW * min(others):
+            upstream.bench(now)
+
+    def lost(self, upstream, sent_at, now, timeout=True):
+        upstream.in_flight -= 1
+        upstream.counters['timeouts' if timeout else 'failures'] += 1
+        if timeout:
+            upstream.rtt.backoff()
+        upstream.health *= RESOLVER_DECAY
+        if upstream.health < RESOLVER_HEALTH_MIN:
+            upstream.bench(now)
+
+    def state(self):
+        state = []
+        for u in self.upstreams:
+            s = dict(u.counters)
+            s.update(address=u.address, health=u.health,
+                     in_flight=u.in_flight, srtt=u.rtt.srtt,
+                     rto=u.rtt.rto, benched_until=u.benched_until)
+            state.append(s)
+        return state
+
+
+def collect_channel(metrics, chid, score_board, systems):
+    # gauges of one end of a channel, for Metrics.collect
+    prefix = 'channel.%d.' % chid
+    metrics.gauge(prefix + 'backlog', len(score_board.backlog))
+    metrics.gauge(prefix + 'rows', len(systems.systems))
+    metrics.gauge(prefix + 'tries', systems.tries)
+    metrics.gauge(prefix + 'missing', bin(systems.missing()).count('1'))
+    metrics.gauge(prefix + 'bytes_out', score_board.counters['pushed'])
+    metrics.gauge(prefix + 'bytes_in', systems.received)
+    metrics.gauge(prefix + 'compression', score_board.compression_ratio())
+    metrics.gauge(prefix + 'sent_hit_rate', score_board.sent.hit_rate())
+    # a hit rate that drops as this reaches its limit calls for a bigger one
+    metrics.gauge(prefix + 'sent', len(score_board.sent))
+    metrics.gauge(prefix + 'sent_limit', score_board.sent.limit)
+    if score_board.profile.tune:
+        for k, v in score_board.tuner.state().items():
+            metrics.gauge(prefix + 'tune.' + k, v)
+
+
+# the server keeps channels by id, with caps so that thousands of them fit;
+# Systems already holds at most SYSTEMS_MAX_ROWS rows, fewer would stall
+# decoding as extracted rows stay until the remote acks
+CHANNELS_MAX = 4096
+CHANNEL_IDLE = 600.0  # seconds without a query before a channel goes
+CHANNEL_STALE_MAX = 8  # stale transmissions in a row: not the owner's
+CHANNEL_SENT_MAX = 1024  # per channel, see SentHistory
+
+
+def opens_channel(transmission, profile=None):
+    # what opens a channel on the server: a client that heard nothing yet
+    # mixes its first mid in every system and acks nothing in its headers,
+    # see Scoreboard.opening; anything else on an unknown chid belongs to
+    # a channel we reaped, or to another server, the client is told so
+    profile = PROFILE if profile is None else profile
+    system = System(profile).from_transmission(transmission)
+    return (system.ack is None
+            and profile.successor(INVALID_MID) in system.mids)
+
+
+REPLY_CACHE_MAX = 256  # per channel
+REPLY_TTL = 10.0  # seconds, resolvers retry within that
+
+
+class ReplyCache:
+    # answers by query name, a retried or duplicated query gets the same
+    # answer again instead of going through the systems a second time
+    def __init__(self, limit=REPLY_CACHE_MAX, ttl=REPLY_TTL):
+        self.limit = limit
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (time, reply)
+        self.lookups = 0
+        self.hits = 0
+
+    def get(self, key, now):
+        self.lookups += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > self.ttl:
+            del self.entries[key]
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, reply, now):
+        self.entries[key] = (now, reply)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+
+class ChannelTable:
+    # channels by id, the least recently active first
+    def __init__(self, limit=CHANNELS_MAX, idle=CHANNEL_IDLE):
+        self.limit = limit
+        self.idle = idle
+        self.channels = {}
+        self.active = collections.OrderedDict()  # chid -> last query time
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __contains__(self, chid):
+        return chid in self.channels
+
+    def items(self):
+        return self.channels.items()
+
+    def full(self):
+        return len(self.channels) >= self.limit
+
+    def get(self, chid, now):
+        channel = self.channels.get(chid)
+        if channel is not None:
+            self.active[chid] = now
+            self.active.move_to_end(chid)
+        return channel
+
+    def add(self, chid, channel, now):
+        assert(chid not in self.channels and not self.full())
+        self.channels[chid] = channel
+        self.active[chid] = now
+
+    def remove(self, chid):
+        self.active.pop(chid, None)
+        return self.channels.pop(chid, None)
+
+    def expired(self, now):
+        # idle channels, taken out of the table
+        expired = []
+        while len(self.active) > 0:
+            chid, last = next(iter(self.active.items()))
+            if now - last < self.idle:
+                break
+            expired.append(self.remove(chid))
+        return expired
+
+
+HASH_REPLICAS = 64  # points per worker
+
+
+def spread_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          byteorder='little')
+
+
+class ConsistentHash:
+    # channel ids to workers; a worker owns the arcs ending at its points,
+    # so a change in the number of workers only moves a share of channels
+    def __init__(self, workers, replicas=HASH_REPLICAS):
+        points = sorted((spread_hash(b'%d-%d' % (worker, i)), worker)
+                        for worker in range(workers)
+                        for i in range(replicas))
+        self.keys = [key for key, _ in points]
+        self.workers = [worker for _, worker in points]
+
+    def lookup(self, chid):
+        key = spread_hash(struct.pack(CHID_FORMAT, chid))
+        i = bisect.bisect(self.keys, key) % len(self.keys)
+        return self.workers[i]
+
+
+# the pumps, what both ends do on either engine: client.py and server.py
+# (twisted) and bromine/aio.py (asyncio) subclass them with the i/o, the
+# methods marked engine below. The local end of a channel is a connection,
+# with MUX streams that have write(), close() and throttle().
+CNAMES = 2  # answers per query when we have data to send, without EDNS0
+UDP_SIZE = 512  # what we can answer when the client does not tell
+
+
+class UnknownChannel(Exception):
+    pass  # the engine answers NXDOMAIN, see ClientPump.unknown()
+
+
+class Pump:
+    def __init__(self, score_board, systems):
+        self.score_board = score_board
+        self.systems = systems
+        self.last_ack = INVALID_MID
+
+    def take(self):
+        # what the remote's transmissions brought in, and what piled up since
+        if self.systems.features & FEATURE_PIGGYBACK:
+            # acks go in our headers from now on, see make_transmission
+            self.score_board.start_piggyback(self.systems.features)
+
+        last_seen = self.systems.last_seen_remote_mid
+        # standalone acks every period mids, even when extraction jumps
+        # over a multiple, until both ends piggyback (ours also tell the
+        # remote we can)
+        piggyback = self.score_board.piggyback and self.systems.piggybacking
+        period = self.score_board.tuner.ackperiod
+        if not piggyback and last_seen // period != self.last_ack // period:
+            self.last_ack = last_seen
+            self.score_board.push_ack(last_seen)
+        else:
+            self.score_board.last_seen_remote_mid = last_seen
+
+        for ack in self.systems.acks:
+            remote_last_seen_remote_mid = ack[0]
+            self.score_board.retire(remote_last_seen_remote_mid)
+
+        # what blocks either end, see Scoreboard.steer()
+        if self.systems.sack is not None:
+            self.score_board.steer(*self.systems.sack)
+        self.score_board.missing_remote_mids = self.systems.missing()
+        # loss reports both ways, see Tuner
+        self.score_board.tune(self.systems)
+
+        if self.systems.features & FEATURE_ZLIB:
+            # the remote inflates, we may deflate
+            self.score_board.start_compression()
+
+        # when the connection is not ready: do not write, do not commit
+        if self.ready():
+            for d in self.systems.data:
+                self.deliver(d)
+
+            self.systems.commit()
+
+        # whatever piled up since goes out next
+        self.refill()
+        self.score_board.flush()
+        self.throttle()
+
+    def empty(self):
+        return self.score_board.empty()
+
+    def ready(self):
+        return True
+
+    def deliver(self, data):
+        pass  # engine: to the connection
+
+    def refill(self):
+        pass  # see MuxClientPump, MuxServerPump
+
+    def throttle(self):
+        pass  # engine: see Backpressure
+
+
+class ClientPump(Pump):
+    # the client's end: its queries carry our transmissions, their answers
+    # the server's; the engine sends what send_query() gets and tells what
+    # became of it with received(), unknown() or failed(), and sets closed
+    # when the connection goes
+    def __init__(self, servers, mode, profile=PROFILE):
+        # our channel is new to the server until it answers
+        score_board = Scoreboard(profile=profile)
+        score_board.opening = True
+        Pump.__init__(self, score_board, Systems(profile=profile))
+        self.mode = mode  # see DOWNSTREAM_MODES
+        # one resolver per upstream, queries are striped across them
+        self.pool = ResolverPool(servers)
+
+        # keep track of queries
+        self.cc = CongestionControl()
+        self.remote_busy = False  # the server has more for us
+        self.polls = 0  # outside of cc, see polling()
+        self.chid_picked_at = self.now()
+        self.closed = False  # what is in flight or in the backlog still goes
+        self.done = False  # no more queries, see stop()
+
+        if METRICS.enabled:
+            METRICS.collect(self.collect)
+
+    def now(self):
+        raise NotImplementedError  # engine: seconds
+
+    def later(self):
+        raise NotImplementedError  # engine: pump() in a moment
+
+    def send_query(self, host, upstream, timeout, sent_at, poll):
+        raise NotImplementedError  # engine
+
+    def stop(self):
+        raise NotImplementedError  # engine: no more pump() on its own
+
+    def lose(self):
+        raise NotImplementedError  # engine: the server forgot our channel
+
+    def collect(self, metrics):
+        chid = self.score_board.chid
+        collect_channel(metrics, chid, self.score_board, self.systems)
+        prefix = 'channel.%d.' % chid
+        for k, v in self.cc.state().items():
+            metrics.gauge(prefix + k, v)
+        for state in self.pool.state():
+            prefix = 'resolver.%s:%d.' % state.pop('address')
+            for k, v in state.items():
+                metrics.gauge(prefix + k, v)
+
+    def pump(self):
+        if (self.closed and self.empty() and self.cc.in_flight == 0
+                and self.polls == 0):
+            # the connection went, and what it left went through
+            self.done = True
+        if self.done:
+            self.stop()
+            return
+
+        if self.systems.last_seen_remote_mid != INVALID_MID:
+            # the server opened our channel, see opens_channel
+            self.score_board.opening = False
+        self.take()
+
+        poll = False
+        if self.empty() and not self.remote_busy:
+            # idle, a single query keeps the downstream open
+            count = self.idle_queries()
+            poll = self.polling()
+        else:
+            # when busy, fill the window in one go
+            count = self.cc.window()
+
+        if count == 0:
+            return
+
+        now = self.now()
+        upstreams = []
+        for _ in range(count):
+            upstream = self.pool.pick(now)
+            if upstream is None:
+                break  # every resolver is full
+            self.pool.sent(upstream)
+            upstreams.append(upstream)
+
+        hosts = self.score_board.transmit_batch(len(upstreams), poll)
+        TRACE.record_all(TRACE_NAME_OUT, hosts)
+        for host, upstream in zip(hosts, upstreams):
+            # the resolver's own rto, the slowest one should not set the pace
+            timeout = upstream.rtt.rto
+            if poll:
+                # the server may sit on it
+                timeout += LONGPOLL_HOLD
+                self.polls += 1
+            else:
+                self.cc.sent()
+            self.send_query(host, upstream, timeout, now, poll)
+        METRICS.count('client.queries', len(upstreams))
+        if poll:
+            METRICS.count('client.polls', len(upstreams))
+
+    def idle_queries(self):
+        if self.closed:
+            return 0  # nothing left to wait for, see pump()
+        if self.polling():
+            return self.score_board.profile.longpoll - self.polls
+        return 1 if self.cc.in_flight == 0 and self.polls == 0 else 0
+
+    def polling(self):
+        # with LONGPOLL, idle queries wait on the server for its data,
+        # see POLL_CHECK; they do not count in cc
+        return (self.score_board.profile.longpoll > 0
+                and self.score_board.can_poll())
+
+    def answered(self, upstream, sent_at, now, poll):
+        if poll:
+            self.polls -= 1
+            self.pool.answered(upstream, sent_at, now, sample=False)
+        else:
+            self.pool.answered(upstream, sent_at, now)
+            self.cc.answered(sent_at, now)
+            self.score_board.tuner.sample(False)
+
+    def lost(self, upstream, sent_at, now, timeout, poll):
+        self.pool.lost(upstream, sent_at, now, timeout)
+        if poll:
+            self.polls -= 1
+        else:
+            self.cc.lost(sent_at, now, timeout)
+            self.score_board.tuner.sample(True)
+
+    def received(self, values, upstream, sent_at, poll=False):
+        # the answers of our type: names with cname, else the records'
+        # values for from_records()
+        now = self.now()
+        self.answered(upstream, sent_at, now, poll)
+        if self.mode == 'cname':
+            TRACE.record_all(TRACE_NAME_IN, values)
+            for name in values:
+                self.systems.add(name)
+            count = len(values)
+        else:
+            transmissions = from_records(self.mode, values)
+            TRACE.record_all(TRACE_PACKED_IN, transmissions)
+            for transmission in transmissions:
+                self.systems.add_transmission(transmission)
+            count = len(transmissions)
+
+        self.remote_busy = count > 1
+        # what came in goes out now, and a poll that came back after a
+        # while was held: another one takes its place
+        held = poll and now - sent_at > LONGPOLL_HOLD / 2
+        if not self.empty() or self.remote_busy or self.systems.data or held:
+            self.pump()
+
+    def unknown(self, upstream, sent_at, poll=False):
+        # the server does not know our channel as ours
+        self.answered(upstream, sent_at, self.now(), poll)
+        if sent_at < self.chid_picked_at:
+            # about the chid we dropped already
+            return
+        if self.systems.last_seen_remote_mid == INVALID_MID:
+            # nothing came through yet, the chid was taken: pick another
+            # one, the server starts afresh with everything we have
+            self.score_board.chid = generate_channel_id()
+            self.chid_picked_at = self.now()
+            self.score_board.sent = SentHistory()
+            METRICS.count('client.chid_collisions')
+        else:
+            # the server reaped our channel, the session is gone
+            self.done = True
+            self.lose()
+
+    def failed(self, upstream, sent_at, timeout, poll=False):
+        # no answer, or SERVFAIL and friends: the resolver gave up on it
+        self.lost(upstream, sent_at, self.now(), timeout, poll)
+        self.later()
+
+
+class MuxClientPump(ClientPump):
+    # with MUX, the one channel every local connection goes through, see
+    # Mux; it does not poll while no connection is open
+    def __init__(self, servers, mode):
+        ClientPump.__init__(self, servers, mode)
+        self.streams = {}  # sid -> stream
+        self.mux = Mux(self.score_board)
+
+    def open(self, stream):
+        sid = self.mux.allocate_sid(self.streams)
+        if sid is None:
+            return None
+        self.streams[sid] = stream
+        self.mux.open(sid)
+        self.later()
+        return sid
+
+    def write(self, sid, data):
+        self.mux.write(sid, data)
+        self.later()
+
+    def close(self, sid):
+        if self.streams.pop(sid, None) is not None:
+            self.mux.close(sid)
+            self.later()
+
+    def deliver(self, data):
+        for kind, sid, payload in self.mux.read(data):
+            stream = self.streams.get(sid)
+            if stream is None:
+                continue  # closed on our side already
+            if kind == MUX_DATA:
+                stream.write(payload)
+            elif kind == MUX_CLOSE:
+                del self.streams[sid]
+                self.mux.drop(sid)
+                stream.close()
+
+    def refill(self):
+        self.mux.feed(self.score_board.tuner.window)
+
+    def throttle(self):
+        for stream in self.streams.values():
+            stream.throttle()
+
+    def empty(self):
+        return self.score_board.empty() and self.mux.idle()
+
+    def idle_queries(self):
+        if len(self.streams) == 0:
+            return 0
+        return ClientPump.idle_queries(self)
+
+    def lose(self):
+        if METRICS.enabled:
+            METRICS.uncollect(self.collect)
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.close()
+
+
+class ServerPump(Pump):
+    # the server's end: each query brings a transmission in, its answer
+    # takes some out, see Responder
+    def __init__(self, channel_id, mode='cname', profile=PROFILE):
+        # data going out, with per channel caps, see ChannelTable
+        Pump.__init__(self, Scoreboard(CHANNEL_SENT_MAX, profile),
+                      Systems(profile=profile))
+        self.channel_id = channel_id
+        self.mode = mode  # picked by the query that opened the channel
+        self.profile = profile  # the tunnel of the query's domain
+        if mode != 'cname':
+            # raw records carry more than names
+            self.score_board.size = PACKED_MAX
+        self.replies = ReplyCache()
+        self.parked = collections.OrderedDict()  # key -> Parked, oldest first
+
+    def close(self):
+        pass  # engine: the connection to the endpoint
+
+    def idle(self):
+        # nothing to answer a poll with but our header
+        return self.empty() and not self.score_board.unflushed
+
+    def wake(self):
+        # data for the client, a poll we sat on takes it
+        if len(self.parked) > 0 and not self.idle():
+            _, parked = self.parked.popitem(last=False)
+            parked.release()
+
+    def pump(self, space=None):
+        # space is what is left in the answer, None when the client did
+        # not tell us (no EDNS0); the query's name went in systems already
+        self.take()
+        return self.give(space)
+
+    def give(self, space):
+        # more bangs in that packet, same bucks
+        # + client understands it needs to pull some more
+        if self.empty():
+            count = 1
+        elif space is None:
+            count = CNAMES
+        else:
+            size = self.score_board.capacity()
+            count = answer_count(self.mode, space, size)
+            count = min(count, len(self.score_board.backlog))
+
+        if self.mode == 'cname':
+            return self.score_board.transmit_batch(count)
+        return self.score_board.encode_batch(count)
+
+
+class MuxServerPump(ServerPump):
+    # with MUX, a connection to the endpoint per stream, see Mux
+    def __init__(self, channel_id, mode='cname', profile=PROFILE):
+        ServerPump.__init__(self, channel_id, mode, profile)
+        self.mux = Mux(self.score_board)
+        self.upstreams = {}  # sid -> upstream
+
+    def upstream(self, sid):
+        # engine: a stream that connect() opens, its end calls lost()
+        raise NotImplementedError
+
+    def ready(self):
+        return True  # the upstreams hold what comes before they connect
+
+    def deliver(self, data):
+        for kind, sid, payload in self.mux.read(data):
+            if kind == MUX_OPEN and sid not in self.upstreams:
+                upstream = self.upstream(sid)
+                self.upstreams[sid] = upstream
+                upstream.connect()
+                METRICS.count('server.streams_opened')
+            elif kind == MUX_DATA and sid in self.upstreams:
+                self.upstreams[sid].write(payload)
+            elif kind == MUX_CLOSE and sid in self.upstreams:
+                self.mux.drop(sid)
+                self.upstreams.pop(sid).close()
+
+    def lost(self, sid, upstream):
+        # the endpoint closed it, or never took it
+        if self.upstreams.get(sid) is upstream:
+            del self.upstreams[sid]
+            self.mux.close(sid)
+            self.wake()
+
+    def refill(self):
+        self.mux.feed(self.score_board.tuner.window)
+
+    def throttle(self):
+        for upstream in self.upstreams.values():
+            upstream.throttle()
+
+    def empty(self):
+        return self.score_board.empty() and self.mux.idle()
+
+    def close(self):
+        upstreams, self.upstreams = self.upstreams, {}
+        for upstream in upstreams.values():
+            upstream.close()
+
+
+class Responder:
+    # the server's side of the queries: channels by id, answers replayed to
+    # retries, polls parked until there is data; the engine makes the
+    # pumps in open_channel() and puts what answer() replies in records
+    def __init__(self, profiles=PROFILES):
+        self.profiles = profiles  # one per domain we answer for
+        self.sockets = ChannelTable()
+
+    def now(self):
+        raise NotImplementedError  # engine: seconds
+
+    def later(self, delay, f):
+        raise NotImplementedError  # engine: a timer, for cancel()
+
+    def cancel(self, timer):
+        raise NotImplementedError  # engine
+
+    def open_channel(self, chid, mode, profile):
+        # engine: a ServerPump, connecting to the endpoint on its own
+        raise NotImplementedError
+
+    def ensure_channel_open(self, chid, codec, mode, profile):
+        now = self.now()
+        socket = self.sockets.get(chid, now)
+        if socket is not None:
+            return socket
+        if self.sockets.full():
+            return None
+
+        socket = self.open_channel(chid, mode, profile)
+        # answer in the codec the client picked
+        socket.score_board.codec = codec
+        self.sockets.add(chid, socket, now)
+        METRICS.count('server.channels_opened')
+        return socket
+
+    def reap(self):
+        for socket in self.sockets.expired(self.now()):
+            for parked in list(socket.parked.values()):
+                parked.release()
+            socket.close()
+            METRICS.count('server.channels_reaped')
+
+    def answer(self, name, mode, udp_size, reply):
+        # reply(items) gets what goes in the answer (names with cname, else
+        # transmissions for to_records), now or when a parked poll is
+        # released; udp_size is what the query advertised, None without
+        # EDNS0. Raises UnknownChannel
+        profile = find_profile(name, self.profiles)
+        if profile is None:
+            reply(())
+            return
+
+        transmission = profile.from_address(name)
+        chid = get_channel_id(transmission)
+        if (chid not in self.sockets
+                and not opens_channel(transmission, profile)):
+            # a channel we reaped, or someone else's: tell them
+            METRICS.count('server.unknown_channels')
+            raise UnknownChannel(name)
+        codec = address_codec(name)
+        socket = self.ensure_channel_open(chid, codec, mode, profile)
+        if socket is None or socket.mode != mode or socket.profile is not profile:
+            # no room for a new channel, or what we have in store
+            # would not fit: come back later
+            reply(())
+            return
+
+        # a retry, maybe with a new random case when the codec allows it
+        key = name if codec == 'base64' else name.lower()
+        replayed = socket.replies.get(key, self.now())
+        if replayed is not None:
+            METRICS.count('server.replayed')
+            reply(replayed)
+            return
+
+        TRACE.record(TRACE_NAME_IN, name)
+        socket.systems.add(name)
+        if socket.systems.stale >= CHANNEL_STALE_MAX:
+            # someone else's chid, or a channel we reaped: tell them
+            raise UnknownChannel(name)
+
+        # header, question and our OPT record come first
+        question = 12 + len(name) + 2 + 4
+        if udp_size is not None:
+            space = udp_size - question - OPT_SIZE
+        elif mode != 'cname':
+            space = UDP_SIZE - question
+        else:
+            space = None
+
+        if socket.systems.polled and profile.longpoll > 0:
+            # nothing for it yet, hold it, see Parked
+            parked = socket.parked.get(key)
+            if parked is None:
+                socket.take()
+                if socket.idle():
+                    parked = Parked(self, socket, mode, key, space)
+            if parked is not None:
+                parked.waiting.append(reply)
+                return
+
+        reply(self.respond(socket, mode, key, space))
+
+    def respond(self, socket, mode, key, space):
+        items = socket.pump(space)
+        TRACE.record_all(trace_kind(mode), items)
+        METRICS.count('server.queries')
+        METRICS.count('server.answers', len(items))
+        socket.replies.put(key, items, self.now())
+        return items
+
+    def collect(self, metrics):
+        for chid, socket in self.sockets.items():
+            collect_channel(metrics, chid, socket.score_board, socket.systems)
+            metrics.gauge('channel.%d.replayed' % chid,
+                          socket.replies.hit_rate())
+        metrics.gauge('server.channels', len(self.sockets))
+
+
+class Parked:
+    # a poll we sit on until its channel has data, see POLL_CHECK; a
+    # channel holds LONGPOLL of them at most, the oldest goes first.
+    # waiting holds the reply of the query and of the resolver's retries
+    def __init__(self, responder, socket, mode, key, space):
+        self.responder = responder
+        self.socket = socket
+        self.answer = (mode, key, space)
+        self.waiting = []
+        self.timer = responder.later(LONGPOLL_HOLD, self.release)
+        socket.parked[key] = self
+        if len(socket.parked) > socket.profile.longpoll:
+            _, oldest = socket.parked.popitem(last=False)
+            oldest.release()
+        METRICS.count('server.parked')
+
+    def release(self):
+        self.responder.cancel(self.timer)
+        key = self.answer[1]
+        if self.socket.parked.get(key) is self:
+            del self.socket.parked[key]
+        items = self.responder.respond(self.socket, *self.answer)
+        for reply in self.waiting:
+            reply(items)
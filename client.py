@@ -1,6 +1,13 @@
 import bromine
 import sys
 
+TESTING = False
+
+if __name__ == '__main__' and bromine.CONFIG.get('engine') == 'asyncio':
+    # the same client without twisted, see bromine/aio.py
+    from bromine import aio
+    sys.exit(aio.main(['client'] + ['--testing'] * TESTING))
+
 from twisted.names import client, dns
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
@@ -9,95 +16,194 @@ from twisted.internet.endpoints import TCP4ServerEndpoint
 
 # https://twistedmatrix.com/documents/13.1.0/core/howto/servers.html
 
-TESTING = False
 if TESTING:
     SLOW = 1e-2
     FAST = SLOW
-    REQS = 2
 else:
     SLOW = 1  # dont pump too fast when not busy
     FAST = 1e-2
-    REQS = 5  # when busy, we may need help
+# when busy, bromine.CongestionControl says how many queries can be out
+
+MODE = bromine.CONFIG.get('downstream', 'cname')
+QUERY_TYPES = {'cname': dns.CNAME, 'txt': dns.TXT,
+               'null': dns.NULL, 'aaaa': dns.AAAA}
+EDNS_SIZE = 1232  # udp payload we can take in, the server fills it
+
+
+class EdnsProtocol(dns.DNSDatagramProtocol):
+    def writeMessage(self, message, address):
+        message.additional.append(dns._OPTHeader(udpPayloadSize=EDNS_SIZE))
+        dns.DNSDatagramProtocol.writeMessage(self, message, address)
+
+
+class EdnsResolver(client.Resolver):
+    # advertise EDNS0 in every query
+    def _connectedProtocol(self, interface=''):
+        proto = EdnsProtocol(self, reactor=self._reactor)
+        self._reactor.listenUDP(0, proto, interface=interface)
+        return proto
 
 
-class SocketInDns(Protocol):
+RESOLVERS = {}  # address -> EdnsResolver, shared by the channels
+
+
+def resolver(address):
+    if address not in RESOLVERS:
+        RESOLVERS[address] = EdnsResolver(servers=[address])
+    return RESOLVERS[address]
+
+
+def upstreams():
+    if TESTING:
+        return [('127.0.0.1', 5553)]
+    return bromine.configured_resolvers()
+
+
+class SocketInDns(bromine.ClientPump, Protocol):
+    # the pump is bromine.ClientPump, what is here is twisted's i/o
     def __init__(self):
-        if TESTING:
-            self.resolver = client.Resolver(servers=[('127.0.0.1', 5553)])
-        else:
-            self.resolver = client.Resolver('/etc/resolv.conf')
+        bromine.ClientPump.__init__(self, upstreams(), MODE)
+        self.looping = LoopingCall(self.pump)
 
-        # data going out
-        self.score_board = bromine.Scoreboard()
-        self.last_ack = bromine.INVALID_MID
+    def now(self):
+        return reactor.seconds()
 
-        # data coming in
-        self.systems = bromine.Systems()
+    def later(self):
+        reactor.callLater(FAST, self.pump)
 
-        # keep track of callbacks
-        self.requested = 0  # looping call not withstanding
-        LoopingCall(self.pump).start(SLOW)
+    def connectionMade(self):
+        self.backpressure = bromine.Backpressure(
+            self.transport.pauseProducing, self.transport.resumeProducing)
+        self.looping.start(SLOW)
 
     def dataReceived(self, data):
         self.score_board.push_data(data)
-        reactor.callLater(FAST, self.pump)
+        self.throttle()
+        self.later()
+
+    def throttle(self):
+        # no more reading while the backlog is deep, see bromine.Backpressure
+        self.backpressure.update(self.score_board.backlog.pending)
+
+    def connectionLost(self, reason):
+        # what is in flight or in the backlog still goes through, then
+        # the pump stops
+        self.closed = True
+        if bromine.METRICS.enabled:
+            bromine.METRICS.uncollect(self.collect)
 
     def clientConnectionLost(self, connector, reason):
         print('connection lost:', reason.getErrorMessage())
         sys.exit(0)
 
-    def empty(self):
-        return all(l.type_ == bromine.TYPE_ACK for l in self.score_board.backlog.values())
+    def send_query(self, host, upstream, timeout, sent_at, poll):
+        query = dns.Query(host, QUERY_TYPES[MODE], dns.IN)
+        task = resolver(upstream.address).queryUDP([query], [timeout])
+        args = (upstream, sent_at, poll)
+        task.addCallbacks(self.ok_, self.error_,
+                          callbackArgs=args, errbackArgs=args)
+
+    def deliver(self, data):
+        if not self.closed:
+            self.transport.write(data)
+
+    def stop(self):
+        if self.looping.running:
+            self.looping.stop()
+
+    def lose(self):
+        self.transport.loseConnection()
 
-    def pump(self):
-        self.requested -= 1
-        if self.requested > REQS:
+    def ok_(self, reply, upstream, sent_at, poll=False):
+        if reply.rCode == dns.ENAME:
+            # the server does not know our channel as ours
+            self.unknown(upstream, sent_at, poll)
             return
 
-        last_seen = self.systems.last_seen_remote_mid
-        if last_seen % bromine.CONFIG['ackperiod'] == 0 and self.last_ack != last_seen:
-            self.last_ack = last_seen
-            self.score_board.push_ack(last_seen)
+        if reply.rCode != dns.OK:
+            # SERVFAIL and friends, the resolver gave up on this one
+            self.failed(upstream, sent_at, False, poll)
+            return
+
+        answers = [a.payload for a in reply.answers
+                   if a.type == QUERY_TYPES[MODE]]
+        if MODE == 'cname':
+            values = [a.name.name for a in answers]
+        elif MODE == 'txt':
+            values = [a.data for a in answers]
+        elif MODE == 'null':
+            values = [a.payload for a in answers]
         else:
-            self.score_board.last_seen_remote_mid = last_seen
+            values = [a.address for a in answers]
+        self.received(values, upstream, sent_at, poll)
 
-        for d in self.systems.data:
-            self.transport.write(d)
+    def error_(self, failure, upstream, sent_at, poll=False):
+        timeout = failure.check(dns.DNSQueryTimeoutError) is not None
+        self.failed(upstream, sent_at, timeout, poll)
 
-        for ack in self.systems.acks:
-            remote_last_seen_remote_mid = ack[0]
-            self.score_board.retire(remote_last_seen_remote_mid)
 
-        self.systems.commit()
+class MuxChannel(bromine.MuxClientPump, SocketInDns):
+    # with MUX, the one channel every local connection goes through, see
+    # bromine.MuxClientPump
+    def __init__(self):
+        bromine.MuxClientPump.__init__(self, upstreams(), MODE)
+        self.looping = LoopingCall(self.pump)
+        self.looping.start(SLOW)
 
-        host = self.score_board.transmit()
-        query = dns.Query(host, dns.CNAME, dns.IN)
-        task = self.resolver.queryUDP([query], [20 * SLOW])
-        task.addCallback(self.ok_)
-        task.addErrback(self.error_)
 
-    def ok_(self, reply):
-        for a in reply.answers:
-            cname = a.payload.name.name
-            self.systems.add(cname)
+class MuxStream(Protocol):
+    def __init__(self, channel):
+        self.channel = channel
+        self.sid = None
 
-        if not self.empty() or len(reply.answers) > 1:
-            reactor.callLater(SLOW, self.pump)
-            self.requested += 1
+    def connectionMade(self):
+        self.backpressure = bromine.Backpressure(
+            self.transport.pauseProducing, self.transport.resumeProducing,
+            bromine.MUX_BUFFER_HIGH, bromine.MUX_BUFFER_LOW)
+        self.sid = self.channel.open(self)
+        if self.sid is None:
+            self.transport.loseConnection()  # every stream id is taken
 
-    def error_(self, failure):
-        reactor.callLater(FAST, self.pump)
-        self.requested += 1
+    def dataReceived(self, data):
+        self.channel.write(self.sid, data)
+        self.throttle()
+
+    def throttle(self):
+        # what waits in the Mux, for this stream alone
+        self.backpressure.update(self.channel.mux.buffered(self.sid))
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.sid is not None:
+            self.channel.close(self.sid)
 
 
 class ClientFactory(Factory):
+    channel = None
+
     def buildProtocol(self, addr):
         print("connection from", addr)
-        return SocketInDns()
+        if not bromine.PROFILE.mux:
+            return SocketInDns()
+        if self.channel is None or self.channel.done:
+            self.channel = MuxChannel()
+        return MuxStream(self.channel)
+
+
+def log_metrics():
+    print('metrics', bromine.METRICS.line(), flush=True)
 
 
 if __name__ == '__main__':
     endpoint = TCP4ServerEndpoint(reactor, bromine.CONFIG['port'])
     endpoint.listen(ClientFactory())
 
+    if bromine.METRICS.enabled:
+        LoopingCall(log_metrics).start(bromine.CONFIG['metrics'], now=False)
+
     reactor.run()
@@ -1,112 +1,401 @@
 import bromine
+import collections
+import itertools
+import os
 import pwd
+import shutil
+import struct
+import sys
+import tempfile
 
-from twisted.names import dns, server, client, cache
+TESTING = False
+
+if (__name__ == '__main__' and sys.argv[1:2] != ['worker']
+        and bromine.CONFIG.get('engine') == 'asyncio'):
+    # the same server without twisted nor twistd, see bromine/aio.py
+    from bromine import aio
+    sys.exit(aio.main(['server'] + ['--testing'] * TESTING))
+
+from socket import AF_INET6, inet_ntop
+
+from twisted.names import dns, server, client
 from twisted.application import service, internet
-from twisted.internet.task import LoopingCall
-from twisted.internet import reactor
-from twisted.internet.protocol import Protocol
+from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import (DatagramProtocol, Protocol,
+                                       ProcessProtocol, ServerFactory)
 from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 
-TESTING = False
-DOMAIN = bromine.CONFIG['domain'].encode('ascii')
+QUERY_TYPES = {'cname': dns.CNAME, 'txt': dns.TXT,
+               'null': dns.NULL, 'aaaa': dns.AAAA}
+MODES = {v: k for k, v in QUERY_TYPES.items()}
 
 
-class SocketPump(Protocol):
-    def __init__(self, channel_id):
-        self.channel_id = channel_id
+class SocketPump(bromine.ServerPump, Protocol):
+    # the pump is bromine.ServerPump, what is here is twisted's i/o
+    def __init__(self, channel_id, mode='cname', profile=bromine.PROFILE):
+        bromine.ServerPump.__init__(self, channel_id, mode, profile)
+        self.backpressure = None  # once connected
 
-        # data going out
-        self.score_board = bromine.Scoreboard()
-        self.last_ack = bromine.INVALID_MID
-
-        # data coming in
-        self.systems = bromine.Systems()
+    def connectionMade(self):
+        self.backpressure = bromine.Backpressure(
+            self.transport.pauseProducing, self.transport.resumeProducing)
 
     def dataReceived(self, data):
         self.score_board.push_data(data)
+        self.throttle()
+        self.wake()
+
+    def throttle(self):
+        # no more reading while the backlog is deep, see bromine.Backpressure
+        if self.backpressure is not None:
+            self.backpressure.update(self.score_board.backlog.pending)
 
-    def empty(self):
-        return all(bromine.get_type(l) == bromine.TYPE_ACK for l in self.score_board.backlog.values())
+    def close(self):
+        if self.transport is not None:
+            self.transport.loseConnection()
 
-    def pump(self, data):
-        if data is not None:
-            self.systems.add(data)
+    def ready(self):
+        return self.transport is not None
 
-        last_seen = self.systems.last_seen_remote_mid
-        if last_seen % bromine.CONFIG['ackperiod'] == 0 and self.last_ack != last_seen:
-            self.last_ack = last_seen
-            self.score_board.push_ack(last_seen)
-        else:
-            self.score_board.last_seen_remote_mid = last_seen
+    def deliver(self, data):
+        self.transport.write(data)
 
-        for ack in self.systems.acks:
-            remote_last_seen_remote_mid = ack[0]
-            self.score_board.retire(remote_last_seen_remote_mid)
 
-        # when transport not ready: do not write, do not commit
+class MuxPump(bromine.MuxServerPump):
+    # with MUX, a connection to the endpoint per stream, see bromine.Mux
+    def upstream(self, sid):
+        return MuxUpstream(self, sid)
+
+
+class MuxUpstream(Protocol):
+    def __init__(self, pump, sid):
+        self.pump = pump
+        self.sid = sid
+        self.early = []  # written before we connected
+        self.closed = False
+        self.backpressure = None  # once connected
+
+    def connect(self):
+        point = TCP4ClientEndpoint(reactor, "localhost",
+                                   self.pump.profile.endpoint)
+        connecting = connectProtocol(point, self)
+        connecting.addErrback(lambda _: self.lost())
+
+    def connectionMade(self):
+        self.backpressure = bromine.Backpressure(
+            self.transport.pauseProducing, self.transport.resumeProducing,
+            bromine.MUX_BUFFER_HIGH, bromine.MUX_BUFFER_LOW)
+        for data in self.early:
+            self.transport.write(data)
+        self.early = None
+        if self.closed:
+            self.transport.loseConnection()
+
+    def write(self, data):
+        if self.early is not None:
+            self.early.append(data)
+        else:
+            self.transport.write(data)
+
+    def close(self):
+        self.closed = True
         if self.transport is not None:
-            for d in self.systems.data:
-                self.transport.write(d)
+            self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        self.pump.mux.write(self.sid, data)
+        self.throttle()
+        self.pump.wake()
 
-            self.systems.commit()
+    def throttle(self):
+        # what waits in the Mux, for this stream alone
+        if self.backpressure is not None:
+            self.backpressure.update(self.pump.mux.buffered(self.sid))
 
-        host = self.score_board.transmit()
-        return host
+    def connectionLost(self, reason):
+        self.lost()
 
+    def lost(self):
+        self.pump.lost(self.sid, self)
 
-class DnsInSocket(client.Resolver):
+
+class DnsInSocket(client.Resolver, bromine.Responder):
+    # the answers are bromine.Responder's, what is here is twisted's records
     def __init__(self):
         INVALID = ('0.0.0.0', 0)  # do not relay queries
         client.Resolver.__init__(self, servers=[INVALID])
-        self.sockets = {}
+        bromine.Responder.__init__(self)
+
+    def now(self):
+        return reactor.seconds()
+
+    def later(self, delay, f):
+        return reactor.callLater(delay, f)
 
-    def ensure_channel_open(self, chid):
-        if chid in self.sockets:
-            return self.sockets[chid]
+    def cancel(self, timer):
+        if timer.active():
+            timer.cancel()
 
-        socket = SocketPump(chid)
-        point = TCP4ClientEndpoint(
-            reactor, "localhost", bromine.CONFIG['endpoint'])
+    def open_channel(self, chid, mode, profile):
+        if profile.mux:
+            # streams connect on their own
+            return MuxPump(chid, mode, profile)
+        socket = SocketPump(chid, mode, profile)
+        point = TCP4ClientEndpoint(reactor, "localhost", profile.endpoint)
         connectProtocol(point, socket)
-        self.sockets[chid] = socket
         return socket
 
-    def lookupCanonicalName(self, name, timeout=None):
-        if name[-len(DOMAIN):] != DOMAIN:
-            return [(), (), ()]
+    def resolve(self, name, mode, udp_size, opt=None):
+        # udp_size is what the client can take in, see EdnsServerFactory;
+        # our OPT record, opt its size, goes with every answer to a query
+        # that had one, cached or not
+        additional = []
+        if opt is not None:
+            # OPT: root name, class is the udp payload size
+            additional.append(dns.RRHeader(
+                b'', dns.OPT, opt, 0, dns.UnknownRecord(b'', 0)))
+
+        d = defer.Deferred()
+
+        def reply(items):
+            d.callback([self.records(name, mode, items), (), additional])
+        try:
+            self.answer(name, mode, udp_size, reply)
+        except bromine.UnknownChannel:
+            raise dns.DomainError(name)
+        return d
 
-        transmission = bromine.from_address(name)
-        chid = bromine.get_channel_id(transmission)
-        socket = self.ensure_channel_open(chid)
-        host = socket.pump(name)
-        reply = [dns.RRHeader(
+    def records(self, name, mode, items):
+        if mode == 'cname':
+            records = [dns.Record_CNAME(host, 0) for host in items]
+        elif mode == 'txt':
+            records = [dns.Record_TXT(*strings, ttl=0)
+                       for strings in bromine.to_records(mode, items)]
+        elif mode == 'null':
+            records = [dns.Record_NULL(blob, 0)
+                       for blob in bromine.to_records(mode, items)]
+        else:
+            records = [dns.Record_AAAA(inet_ntop(AF_INET6, chunk), 0)
+                       for chunk in bromine.to_records(mode, items)]
+
+        return [dns.RRHeader(
             name,
-            dns.CNAME,
+            QUERY_TYPES[mode],
             dns.IN,
             0,
-            dns.Record_CNAME(host, 0)
-        )]
+            record
+        ) for record in records]
+
+
+class EdnsServerFactory(server.DNSServerFactory):
+    # let the resolver know how much the client can take in, query by query
+    def handleQuery(self, message, protocol, address):
+        query = message.queries[0]
+        mode = MODES.get(query.type)
+        if mode is None:
+            # not ours, the resolver chain says no
+            return server.DNSServerFactory.handleQuery(
+                self, message, protocol, address)
+
+        sizes = [rr.cls for rr in message.additional if rr.type == dns.OPT]
+        if address is None:
+            # over tcp
+            udp_size = 65535
+        elif len(sizes) > 0:
+            udp_size = max(bromine.UDP_SIZE, sizes[0])
+        else:
+            udp_size = None
+        opt = udp_size if len(sizes) > 0 else None
+        return (
+            defer.maybeDeferred(resolver.resolve, query.name.name, mode,
+                                udp_size, opt)
+            .addCallback(self.gotResolverResponse, protocol, message, address)
+            .addErrback(self.gotResolverError, protocol, message, address))
+
+
+# with WORKERS > 0, the process listening on port 53 only routes queries:
+# it reads the channel id off the question name and relays the packet to
+# the worker owning that channel over unix datagram sockets; workers run
+# the usual resolver and send the reply back the same way.
+# A relayed packet is: u8 tcp | u32 tag | dns message
+RELAY_FORMAT = "<BI"
+RELAY_SIZE = struct.calcsize(RELAY_FORMAT)
+RELAY_PENDING_MAX = 65536  # replies we wait for, the oldest are dropped
+
+
+def question_name(packet):
+    # name of the first question, without decoding the whole message
+    labels = []
+    i = 12  # header
+    while packet[i] != 0:
+        length = packet[i]
+        if length & 0xc0:
+            raise ValueError("no compression in questions")
+        labels.append(packet[i + 1:i + 1 + length])
+        i += 1 + length
+    return b'.'.join(labels)
+
+
+def channel_of(packet):
+    try:
+        name = question_name(packet)
+        profile = bromine.find_profile(name)
+        if profile is None:
+            return None
+        return bromine.get_channel_id(profile.from_address(name))
+    except (IndexError, ValueError, struct.error):
+        return None
+
 
-        if not socket.empty():
-            # more bangs in that packet, same bucks
-            # + client understands it needs to pull some more
-            host = socket.pump(None)
-            reply.append(dns.RRHeader(
-                name,
-                dns.CNAME,
-                dns.IN,
-                0,
-                dns.Record_CNAME(host, 0)
-            ))
+class Dispatcher(DatagramProtocol):
+    # our end of the unix sockets, routes queries and relays replies
+    def __init__(self, paths):
+        self.paths = paths
+        self.hash = bromine.ConsistentHash(len(paths))
+        self.tags = itertools.count()
+        self.pending = collections.OrderedDict()  # tag -> deliver(reply)
 
-        return [reply, (), ()]
+    def route(self, packet, deliver, tcp):
+        chid = channel_of(packet)
+        # everything else goes to the first worker, which says no
+        worker = 0 if chid is None else self.hash.lookup(chid)
+        tag = next(self.tags) & 0xffffffff
+        self.pending[tag] = deliver
+        if len(self.pending) > RELAY_PENDING_MAX:
+            self.pending.popitem(last=False)
+        header = struct.pack(RELAY_FORMAT, tcp, tag)
+        try:
+            self.transport.write(header + packet, self.paths[worker])
+        except OSError:
+            # the worker is not up (yet), the client will ask again
+            self.pending.pop(tag, None)
+            bromine.METRICS.count('dispatcher.dropped')
+
+    def datagramReceived(self, data, address):
+        _, tag = struct.unpack_from(RELAY_FORMAT, data)
+        deliver = self.pending.pop(tag, None)
+        if deliver is not None:
+            deliver(data[RELAY_SIZE:])
+
+
+class FrontDatagram(DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def datagramReceived(self, data, address):
+        def deliver(reply):
+            self.transport.write(reply, address)
+        self.pool.dispatcher.route(data, deliver, False)
+
+
+class FrontStreamFactory(ServerFactory):
+    # DNSProtocol parses the stream, we send the message on as it is
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        return dns.DNSProtocol(self)
+
+    def connectionMade(self, protocol):
+        pass
+
+    def connectionLost(self, protocol):
+        pass
+
+    def messageReceived(self, message, protocol, address=None):
+        def deliver(reply):
+            protocol.transport.write(struct.pack("!H", len(reply)) + reply)
+        self.pool.dispatcher.route(message.toStr(), deliver, True)
+
+
+class WorkerProcess(ProcessProtocol):
+    # a worker's output goes in our log, a dead worker is started again
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def outReceived(self, data):
+        log.msg('worker %d: %s' % (self.index, data.decode(errors='replace')))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        log.msg('worker %d ended: %s' % (self.index, reason.getErrorMessage()))
+        self.pool.spawn(self.index)
+
+
+class WorkerPool(service.Service):
+    def __init__(self, count):
+        self.count = count
+        self.processes = {}
+
+    def startService(self):
+        service.Service.startService(self)
+        self.directory = tempfile.mkdtemp(prefix='bromine-')
+        paths = [self.path(i) for i in range(self.count)]
+        self.dispatcher = Dispatcher(paths)
+        reactor.listenUNIXDatagram(self.path('front'), self.dispatcher)
+        for i in range(self.count):
+            self.spawn(i)
+
+    def path(self, name):
+        return os.path.join(self.directory, '%s.sock' % name)
+
+    def spawn(self, index):
+        if not self.running:
+            return
+        args = [sys.executable, os.path.abspath(__file__), 'worker',
+                self.path(index)]
+        self.processes[index] = reactor.spawnProcess(
+            WorkerProcess(self, index), sys.executable, args, env=os.environ)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except OSError:
+                pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Relay:
+    # stands for the front's protocol when a worker replies
+    def __init__(self, transport, tcp, tag, front):
+        self.transport = transport
+        self.tcp = tcp
+        self.tag = tag
+        self.front = front
+
+    def writeMessage(self, message, address=None):
+        header = struct.pack(RELAY_FORMAT, self.tcp, self.tag)
+        self.transport.write(header + message.toStr(), self.front)
+
+
+class WorkerDatagram(DatagramProtocol):
+    def __init__(self, factory):
+        self.factory = factory
+
+    def datagramReceived(self, data, address):
+        tcp, tag = struct.unpack_from(RELAY_FORMAT, data)
+        message = dns.Message()
+        message.fromStr(data[RELAY_SIZE:])
+        relay = Relay(self.transport, tcp, tag, address)
+        # no address tells EdnsServerFactory the query came over tcp
+        self.factory.messageReceived(
+            message, relay, None if tcp else address)
 
 
 resolver = DnsInSocket()
 
+
+def log_metrics():
+    log.msg('metrics', bromine.METRICS.line())
+
 # create the protocols
-f = server.DNSServerFactory(caches=[cache.CacheResolver()], clients=[resolver])
+# no generic cache, see ReplyCache
+f = EdnsServerFactory(clients=[resolver])
 p = dns.DNSDatagramProtocol(f)
 f.noisy = p.noisy = False
 
@@ -117,9 +406,35 @@ if TESTING:
 else:
     PORT = 53
 
-for (klass, arg) in [(internet.TCPServer, f), (internet.UDPServer, p)]:
-    s = klass(PORT, arg)
-    s.setServiceParent(ret)
+# what runs next to the resolver, in a worker too
+timers = service.MultiService()
+s = internet.TimerService(bromine.CHANNEL_IDLE / 10, resolver.reap)
+s.setServiceParent(timers)
+
+if bromine.METRICS.enabled:
+    bromine.METRICS.collect(resolver.collect)
+    s = internet.TimerService(bromine.CONFIG['metrics'], log_metrics)
+    s.setServiceParent(timers)
+
+if bromine.TRACE.enabled:
+    # twistd dies of the signal that stopped it, atexit or not
+    reactor.addSystemEventTrigger('after', 'shutdown', bromine.TRACE.close)
+
+WORKERS = bromine.CONFIG.get('workers', 0)
+if WORKERS > 0:
+    pool = WorkerPool(WORKERS)
+    pool.setServiceParent(ret)
+    front_datagram = FrontDatagram(pool)
+    front_stream = FrontStreamFactory(pool)
+    for (klass, arg) in [(internet.TCPServer, front_stream),
+                         (internet.UDPServer, front_datagram)]:
+        s = klass(PORT, arg)
+        s.setServiceParent(ret)
+else:
+    for (klass, arg) in [(internet.TCPServer, f), (internet.UDPServer, p)]:
+        s = klass(PORT, arg)
+        s.setServiceParent(ret)
+    timers.setServiceParent(ret)
 
 if TESTING:
     import os
@@ -130,6 +445,20 @@ else:
 application = service.Application('dnsserver', uid, uid)
 ret.setServiceParent(service.IServiceCollection(application))
 
+
+def run_worker(path):
+    log.startLogging(sys.stdout, setStdout=False)
+    if bromine.TRACE.enabled:
+        # a file per worker, named after its socket: 0, 1...
+        name = os.path.splitext(os.path.basename(path))[0]
+        bromine.TRACE.path += '.' + name
+    reactor.listenUNIXDatagram(path, WorkerDatagram(f))
+    timers.startService()
+    reactor.run()
+
+
 if __name__ == '__main__':
-    import sys
-    print("Usage: sudo twistd3 -y /full/path/server.py")
+    if sys.argv[1:2] == ['worker']:
+        run_worker(sys.argv[2])
+    else:
+        print("Usage: sudo twistd3 -y /full/path/server.py")
@@ -1,16 +1,22 @@
+import asyncio
+import base64
+import bench
 import bromine
+import bromine.aio as aio
 import os
 import random
+import struct
+import tempfile
 import unittest
 
 # some tests expect things more or less in order, but $(python -m unittest -k lossy) should work
-#bromine.CONFIG['_fickle'] = 0.99
-# bromine.CONFIG['_tiny'] = 13  # at least 13
+#bromine.module.PROFILE = bromine.TunnelProfile(_fickle=0.99)
+# bromine.module.PROFILE = bromine.TunnelProfile(_tiny=27)  # at least 27
 
 
-def address_to_mids(address):
-    tranmission = bromine.from_address(address)
-    return bromine.System().from_transmission(tranmission).mids
+def address_to_mids(address, profile=bromine.PROFILE):
+    tranmission = profile.from_address(address)
+    return bromine.System(profile).from_transmission(tranmission).mids
 
 
 def is_data(line):
@@ -27,9 +33,9 @@ def data(unit):
 
 
 class Endpoint:
-    def __init__(self):
-        self.emit = bromine.Scoreboard()
-        self.recv = bromine.Systems()
+    def __init__(self, profile=None):
+        self.emit = bromine.Scoreboard(profile=profile)
+        self.recv = bromine.Systems(profile=profile)
         self.data = []
 
     def talk_to(self, rhs):
@@ -71,6 +77,89 @@ class TestCase(unittest.TestCase):
             self.assertTrue(bromine.valid_dns_name(address))
             self.assertEqual(back, data)
 
+    def test_codecs(self):
+        chars = bromine.body_chars(bromine.CONFIG['domain'])
+        for name, codec in bromine.CODECS.items():
+            size = codec.capacity(chars)
+            for length in [1, 2, 3, size // 2, size - 1, size]:
+                data = os.urandom(length)
+                address = bromine.to_address(data, name)
+                self.assertTrue(bromine.valid_dns_name(address))
+                self.assertEqual(bromine.address_codec(address), name)
+                if codec.tag is not None:
+                    # as seen through a resolver doing 0x20 randomization
+                    address = bytes(random.choice([c, c ^ 0x20])
+                                    if chr(c).isalpha() else c
+                                    for c in address)
+                self.assertEqual(bromine.from_address(address), data)
+
+            # capacity is exact
+            self.assertTrue(len(codec.encode(os.urandom(size))) <= chars)
+            self.assertTrue(len(codec.encode(os.urandom(size + 1))) > chars)
+
+    def test_label_starts(self):
+        # every label after the first one starting with '-', '+' in base64
+        size = bromine.max_size('base64')
+        for _ in range(20):
+            b64 = bytearray(base64.b64encode(os.urandom(size)))
+            for i in range(bromine.SUB_NAME_MAX - 1, size * 4 // 3,
+                           bromine.SUB_NAME_MAX):
+                b64[i] = ord('+')
+            data = base64.b64decode(bytes(b64))
+            address = bromine.to_address(data, 'base64')
+            self.assertTrue(bromine.valid_dns_name(address))
+            self.assertEqual(bromine.from_address(address), data)
+
+    def test_records(self):
+        transmissions = [os.urandom(random.randint(1, bromine.PACKED_MAX))
+                         for _ in range(7)]
+        for mode in bromine.DOWNSTREAM_MODES[1:]:
+            records = bromine.to_records(mode, transmissions)
+            random.shuffle(records)
+            back = bromine.from_records(mode, records)
+            self.assertEqual(back, transmissions)
+
+            # what we computed is what we send
+            count = bromine.answer_count(mode, 1000, bromine.PACKED_MAX)
+            size = bromine.answer_size(mode, count, bromine.PACKED_MAX)
+            self.assertTrue(size <= 1000)
+            self.assertTrue(
+                bromine.answer_size(mode, count + 1, bromine.PACKED_MAX) > 1000)
+
+    def test_wire(self):
+        name = bromine.to_address(data(1), 'base64')
+        query = aio.make_query(1234, name, aio.QUERY_TYPES['txt'])
+        qid, flags, back, qtype, question, udp_size = aio.parse_query(query)
+        self.assertEqual((qid, back, udp_size), (1234, name, aio.EDNS_SIZE))
+        self.assertEqual(qtype, aio.QUERY_TYPES['txt'])
+
+        transmissions = [os.urandom(random.randint(1, bromine.PACKED_MAX))
+                         for _ in range(3)]
+        for mode in bromine.DOWNSTREAM_MODES:
+            items = [name] * 2 if mode == 'cname' else transmissions
+            rdatas = aio.to_rdatas(mode, items)
+            reply = aio.make_response(qid, flags, question, aio.RCODE_OK,
+                                      aio.QUERY_TYPES[mode], rdatas, 1232)
+            qid, rcode, values = aio.parse_response(reply, mode)
+            self.assertEqual((qid, rcode), (1234, aio.RCODE_OK))
+            if mode == 'cname':
+                self.assertEqual(values, items)
+            else:
+                self.assertEqual(bromine.from_records(mode, values), items)
+
+        # resolvers compress names, pointing into the question
+        target = b'\x03abc' + struct.pack("!H", 0xc000 | 12)
+        answer = struct.pack("!HHHIH", aio.OWNER, 5, 1, 0, len(target))
+        header = struct.pack(aio.HEADER_FORMAT, qid, aio.FLAG_QR, 1, 1, 0, 0)
+        reply = header + question + answer + target
+        values = aio.parse_response(reply, 'cname')[2]
+        self.assertEqual(values, [b'abc.' + name])
+
+        # a name pointing at itself does not loop
+        header = struct.pack(aio.HEADER_FORMAT, qid, 0, 1, 0, 0, 0)
+        self.assertRaises(aio.WireError, aio.parse_query,
+                          header + b'\xc0\x0c')
+
     def test_ack(self):
         score_board = bromine.Scoreboard()
         systems = bromine.Systems()
@@ -114,9 +203,9 @@ class TestCase(unittest.TestCase):
             self.assertEqual(systems.data[0], payload)
 
     def test_lossy(self):
-        bromine.CONFIG['n'] = 3  # can't do it with N being even
-        score_board = bromine.Scoreboard()
-        systems = bromine.Systems()
+        profile = bromine.TunnelProfile(n=3)  # can't do it with N being even
+        score_board = bromine.Scoreboard(profile=profile)
+        systems = bromine.Systems(profile=profile)
 
         payload = data(30)
         score_board.push_data(payload)
@@ -126,7 +215,7 @@ class TestCase(unittest.TestCase):
             iterations += 1
             #self.assertTrue(iterations < 100)
             address = score_board.transmit()
-            mids = address_to_mids(address)
+            mids = address_to_mids(address, profile)
             if len(mids) == 1 and random.random() < 0.9:
                 pass  # drop
                 # random number generation is heavily tilted towards
@@ -140,6 +229,163 @@ class TestCase(unittest.TestCase):
 
         self.assertEqual(b''.join(systems.data), payload)
 
+    def test_elimination(self):
+        systems = bromine.Systems()
+        slices = [bromine.make_data(data(0.5)) for _ in range(3)]
+
+        def send(*mids):
+            system = bromine.System()
+            for mid in mids:
+                system.mix(mid, slices[mid - 1])
+            systems.add(system.to_address(1))
+
+        # nothing can be solved before the last one
+        send(1, 2)
+        send(2, 3)
+        self.assertEqual(systems.data, [])
+        send(1, 2)  # redundant
+        self.assertEqual(len(systems.systems), 2)
+        send(3)
+        self.assertEqual(systems.data, [bromine.parse_data(s) for s in slices])
+
+    def test_elimination_cap(self):
+        systems = bromine.Systems(max_rows=4)
+        for mid in range(2, 12):
+            system = bromine.System().mix(mid, bromine.make_data(data(0.1)))
+            systems.add(system.to_address(1))
+
+        # mid 1 never came, keep the oldest ones around
+        self.assertEqual(sorted(systems.systems), [1, 2, 3, 4])
+
+    def test_encoder(self):
+        lines = {mid: bromine.make_data(data(random.random()))
+                 for mid in range(1, 40)}
+        selections = [tuple(random.sample(range(1, 40), 3)) for _ in range(9)]
+        expected = [bromine.System() for _ in selections]
+        for system, selection in zip(expected, selections):
+            for mid in selection:
+                system.mix(mid, lines[mid])
+
+        numpy = bromine.module.load_numpy()
+        for backend in {numpy, None}:
+            bromine.module.numpy = backend
+            encoder = bromine.Encoder()
+            for mid, line in lines.items():
+                encoder.add(mid, line)
+            encoder.remove(7)
+            encoder.add(7, lines[7])
+
+            mixed = encoder.mix(selections)
+            for system, payload in zip(expected, mixed):
+                self.assertEqual(
+                    system.to_transmission(1),
+                    bromine.make_transmission(1, system.mids, payload))
+        bromine.module.numpy = numpy
+
+    def test_alias(self):
+        weights = [1, 0, 3, 4]
+        table = bromine.AliasTable(weights)
+        counts = [0] * len(weights)
+        for _ in range(8000):
+            counts[table.sample()] += 1
+        self.assertEqual(counts[1], 0)
+        for w, c in zip(weights, counts):
+            self.assertAlmostEqual(c / 8000, w / sum(weights), delta=0.03)
+
+    def test_soliton(self):
+        score_board = bromine.Scoreboard()
+        score_board.strategy = 'soliton'
+        systems = bromine.Systems()
+
+        payload = data(30)
+        score_board.push_data(payload)
+
+        addresses = set()
+        while len(systems.data) < 30:
+            address = score_board.transmit()
+            self.assertFalse(address in addresses)
+            addresses.add(address)
+            mids = address_to_mids(address)
+            self.assertTrue(0 < len(mids) <= bromine.PROFILE.n)
+            if random.random() < 0.3:
+                continue  # drop
+            systems.add(address)
+            score_board.retire(systems.last_seen_remote_mid)
+
+        self.assertEqual(b''.join(systems.data), payload)
+
+    def test_congestion(self):
+        cc = bromine.CongestionControl()
+        self.assertEqual(cc.window(), 2)
+
+        for _ in range(2):
+            cc.sent()
+        self.assertEqual(cc.window(), 0)
+        cc.answered(0.0, 0.1)
+        cc.answered(0.0, 0.1)
+        self.assertEqual(cc.cwnd, 4)  # slow start
+
+        for _ in range(4):
+            cc.sent()
+        cc.lost(1.0, 2.0)
+        cc.lost(1.0, 2.1)  # same window, only one cut
+        self.assertEqual(cc.cwnd, 2)
+        self.assertEqual(cc.in_flight, 2)
+        cc.lost(3.0, 3.5, timeout=False)
+        self.assertEqual(cc.cwnd, 1)
+        self.assertEqual(cc.state()['failures'], 1)
+        self.assertEqual(cc.state()['reductions'], 2)
+
+    def test_resolver_pool(self):
+        servers = bromine.parse_resolvers(
+            '1.1.1.1, 9.9.9.9:5353, [::1]:54, 2620:fe::fe,')
+        self.assertEqual(servers, [('1.1.1.1', 53), ('9.9.9.9', 5353),
+                                   ('::1', 54), ('2620:fe::fe', 53)])
+
+        pool = bromine.ResolverPool(['a', 'b', 'c'])
+        a, b, c = pool.upstreams
+
+        # unknown resolvers get sampled, load spreads
+        picked = set()
+        for _ in range(3):
+            upstream = pool.pick(0.0)
+            pool.sent(upstream)
+            picked.add(upstream.address)
+        self.assertEqual(picked, {'a', 'b', 'c'})
+        self.assertEqual(a.rtt.rto, bromine.RTO_INITIAL)
+
+        pool.answered(a, 0.0, 0.1)
+        pool.answered(b, 0.0, 0.2)
+        self.assertEqual(pool.pick(0.2), a)
+        # each resolver times its own queries out
+        self.assertAlmostEqual(a.rtt.srtt, 0.1)
+        self.assertAlmostEqual(a.rtt.rto, 0.3)
+        self.assertAlmostEqual(b.rtt.rto, 0.6)
+        for _ in range(2):
+            pool.sent(a)
+            pool.lost(a, 0.2, 1.2)
+        self.assertAlmostEqual(a.rtt.rto, 1.2)  # backed off twice
+        self.assertEqual(pool.state()[0]['rto'], a.rtt.rto)
+        pool.sent(a)
+        pool.lost(a, 0.2, 1.2, timeout=False)  # SERVFAIL, same rto
+        self.assertAlmostEqual(a.rtt.rto, 1.2)
+        pool.answered(c, 0.0, 1.0)  # too slow, benched
+        self.assertGreater(c.benched_until, 1.0)
+
+        # failing resolvers are benched, then come back
+        while b.benched_until < 0:
+            pool.sent(b)
+            pool.lost(b, 1.0, 2.0)
+        self.assertEqual(pool.pick(2.0), a)
+        later = 2.0 + bromine.RESOLVER_BENCH
+        a.in_flight = 5
+        self.assertIn(pool.pick(later), [b, c])
+
+        # full everywhere
+        for u in pool.upstreams:
+            u.in_flight = bromine.RESOLVER_MAX_IN_FLIGHT
+        self.assertIsNone(pool.pick(later))
+
     def test_trim(self):
         PASS_NUM_MESSAGES = 5
         local, remote = Endpoint(), Endpoint()
@@ -164,6 +410,183 @@ class TestCase(unittest.TestCase):
         self.assertFalse(any(is_data(line)
                              for line in local.emit.backlog.values()))
 
+    def test_compression(self):
+        local, remote = Endpoint(), Endpoint()
+        for endpoint in (local, remote):
+            endpoint.emit.compression = 'zlib'
+            endpoint.emit.features = bromine.FEATURE_ZLIB
+
+        # the ack tells remote we can inflate
+        local.one_pass(remote, 3)
+        self.assertEqual(remote.recv.features, bromine.FEATURE_ZLIB)
+        remote.emit.start_compression()
+
+        # an ack from before ACK_CHECK, its padding may look like the flag
+        old = struct.pack("<HHBB", 1, 2, bromine.ACK_MAGIC,
+                          bromine.FEATURE_ZLIB) + bytes(8) + b'\x01'
+        self.assertEqual(bromine.ack_features(old), 0)
+
+        text = b'ls -l /usr/share/doc\n' * 100
+        remote.emit.push_data(text[:1000])
+        remote.emit.push_data(text[1000:])
+        self.assertTrue(remote.emit.empty())  # nothing until the flush
+        remote.emit.flush()
+        self.assertLess(remote.emit.compression_ratio(), 0.2)
+
+        for _ in range(20):
+            remote.one_pass(local, 3)
+            local.one_pass(remote, 3)
+        self.assertEqual(b''.join(local.data), text)
+
+    def test_channel_table(self):
+        chids = {bromine.generate_channel_id() for _ in range(1000)}
+        self.assertEqual(len(chids), 1000)
+
+        table = bromine.ChannelTable(limit=3, idle=10.0)
+        for chid in range(1, 4):
+            table.add(chid, 'channel %d' % chid, 0.0)
+        self.assertTrue(table.full())
+        self.assertEqual(table.get(1, 5.0), 'channel 1')
+        self.assertIsNone(table.get(9, 5.0))
+
+        # 1 was active later on
+        self.assertEqual(table.expired(12.0), ['channel 2', 'channel 3'])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.expired(16.0), ['channel 1'])
+
+        # someone else's mids look stale
+        systems = bromine.Systems()
+        for mid in range(1, 4):
+            system = bromine.System().mix(mid, bromine.make_data(data(0.1)))
+            systems.add(system.to_address(1))
+        self.assertEqual(systems.stale, 0)
+        for mid in range(60000, 60000 + bromine.CHANNEL_STALE_MAX):
+            system = bromine.System().mix(mid, bromine.make_data(data(0.1)))
+            systems.add(system.to_address(1))
+        self.assertEqual(systems.stale, bromine.CHANNEL_STALE_MAX)
+
+    def test_reply_cache(self):
+        cache = bromine.ReplyCache(limit=2, ttl=5.0)
+        cache.put(b'a', 'reply a', 0.0)
+        cache.put(b'b', 'reply b', 1.0)
+        self.assertEqual(cache.get(b'a', 2.0), 'reply a')
+        cache.put(b'c', 'reply c', 3.0)  # b goes, a was used
+        self.assertIsNone(cache.get(b'b', 3.0))
+        self.assertEqual(cache.get(b'a', 4.0), 'reply a')
+        self.assertIsNone(cache.get(b'a', 6.0))  # too old
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_consistent_hash(self):
+        chids = [bromine.generate_channel_id() for _ in range(4000)]
+        four, five = bromine.ConsistentHash(4), bromine.ConsistentHash(5)
+        owners = [four.lookup(chid) for chid in chids]
+        self.assertEqual(owners, [four.lookup(chid) for chid in chids])
+        for worker in range(4):
+            self.assertGreater(owners.count(worker), 600)
+
+        # a new worker takes its share, the others keep their channels
+        moved = [(a, five.lookup(chid)) for a, chid in zip(owners, chids)
+                 if five.lookup(chid) != a]
+        self.assertTrue(all(b == 4 for _, b in moved))
+        self.assertLess(len(moved), 2 * len(chids) / 5)
+
+    def test_metrics(self):
+        off = bromine.Metrics()
+        off.count('a')
+        off.observe('b', 1.0)
+        self.assertEqual(off.snapshot(), {})
+
+        metrics = bromine.Metrics(enabled=True)
+        metrics.count('a')
+        metrics.count('a', 2)
+        for value in [0.0] + [0.1] * 8 + [3.0]:
+            metrics.observe('latency', value)
+        score_board, systems = bromine.Scoreboard(), bromine.Systems()
+        score_board.push_data(data(1))
+        score_board.transmit()
+        metrics.collect(lambda m: bromine.collect_channel(
+            m, 7, score_board, systems))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['a'], 3)
+        self.assertEqual(snapshot['latency.count'], 10)
+        self.assertAlmostEqual(snapshot['latency.p50'], 0.125)
+        self.assertEqual(snapshot['latency.max'], 3.0)
+        self.assertEqual(snapshot['channel.7.backlog'], 1)
+        self.assertEqual(snapshot['channel.7.sent'], 1)
+        self.assertEqual(snapshot['channel.7.sent_limit'], bromine.SENT_MAX)
+        self.assertIn('a=3', metrics.line())
+
+        # a channel that went leaves neither its collector nor its gauges
+        collector = metrics.collectors[0]
+        metrics.uncollect(collector)
+        metrics.uncollect(collector)
+        self.assertEqual(metrics.collectors, [])
+        self.assertNotIn('channel.7.backlog', metrics.snapshot())
+
+    def test_link_simulator(self):
+        def run():
+            return bench.Simulation(seed=1, upload=3000, download=3000,
+                                    loss=0.1, duplicate=0.05,
+                                    jitter=0.05).run()
+
+        result = run()
+        self.assertTrue(result['complete'])
+        self.assertGreater(result['goodput_down'], 0)
+        # same seed, same link
+        again = run()
+        self.assertEqual(result['messages'], again['messages'])
+        self.assertEqual(result['seconds'], again['seconds'])
+
+    def test_piggyback(self):
+        def run(old_server):
+            simulation = bench.Simulation(seed=2, upload=3000, download=3000,
+                                          loss=0.1, jitter=0.05)
+            if old_server:
+                # neither says nor does FEATURE_PIGGYBACK
+                server = simulation.server.score_board
+                server.features = bromine.FEATURE_ZLIB
+                server.start_piggyback = lambda features: None
+            return simulation, simulation.run()
+
+        simulation, result = run(False)
+        self.assertTrue(result['complete'])
+        for peer in (simulation.client, simulation.server):
+            self.assertTrue(peer.score_board.piggyback)
+            self.assertTrue(peer.systems.piggybacking)
+
+        simulation, result = run(True)
+        self.assertTrue(result['complete'])
+        self.assertFalse(simulation.client.score_board.piggyback)
+        self.assertFalse(simulation.server.systems.piggybacking)
+
+    def test_missing(self):
+        score_board = bromine.Scoreboard()
+        systems = bromine.Systems()
+        for _ in range(5):
+            score_board.push_data(data(1))
+
+        # mid 3 gets lost
+        for mid in (1, 2, 4, 5):
+            system = bromine.System().mix(mid, score_board.backlog[mid])
+            systems.add(system.to_address(score_board.chid))
+        self.assertEqual(systems.last_seen_remote_mid, 2)
+        self.assertEqual(systems.missing(), 0b1)
+
+        # the header carries it back
+        score_board.start_piggyback(bromine.FEATURE_SACK)
+        score_board.missing_remote_mids = 0b101
+        address = score_board.transmit()
+        system = bromine.System().from_transmission(
+            bromine.from_address(address))
+        self.assertEqual(system.missing, 0b101)
+
+        score_board.steer(2, systems.missing())
+        for _ in range(3):
+            self.assertEqual(score_board.select_system()[0], 3)
+            for _ in range(bromine.STEER_AGAIN):
+                score_board.steer(2, systems.missing())
+
     def test_variety(self):
         score_board = bromine.Scoreboard()
 
@@ -186,20 +609,388 @@ class TestCase(unittest.TestCase):
             self.assertFalse(address in addresses)
             addresses.add(address)
 
+    def test_backlog(self):
+        profile = bromine.TunnelProfile(reset=23)
+        score_board = bromine.Scoreboard(profile=profile)
+        score_board.mid = 18
+
+        score_board.push_data(data(6))
+        self.assertEqual(list(score_board.backlog), [19, 20, 21, 22, 1, 2])
+        self.assertEqual(score_board.oldest_local_mid(), 19)
+        self.assertFalse(score_board.empty())
+
+        score_board.retire(22)
+        self.assertEqual(score_board.backlog.head(5), [1, 2])
+        self.assertEqual(score_board.oldest_local_mid(), 1)
+
+        score_board.retire(2)
+        self.assertTrue(score_board.empty())
+        self.assertEqual(score_board.oldest_local_mid(), bromine.INVALID_MID)
+
+    def test_profiles(self):
+        # two tunnels side by side in one process
+        small = bromine.TunnelProfile(domain='t.example.org', n=1, reset=23)
+        large = bromine.TunnelProfile(domain='a.b.example.com', n=5)
+        self.assertEqual(large.overhead - small.overhead, 8)
+        self.assertTrue(small.max_size() > large.max_size())
+
+        for profile in (small, large):
+            local, remote = Endpoint(profile), Endpoint(profile)
+            payload = os.urandom(3 * profile.max_size())
+            local.emit.push_data(payload)
+            while b''.join(remote.data) != payload:
+                address = local.emit.transmit()
+                self.assertTrue(address.endswith(profile.tail))
+                self.assertIs(bromine.find_profile(
+                    address.upper(), [small, large]), profile)
+                remote.recv.add(address)
+                remote.pull_data()
+                remote.commit()
+        self.assertIsNone(bromine.find_profile(b'x.example.org', [small]))
+
+    def test_nested_profiles(self):
+        # a tunnel on a subdomain of another one, whatever their order
+        outer = bromine.TunnelProfile(domain='example.org')
+        inner = bromine.TunnelProfile(domain='t.example.org', n=1)
+        for profiles in ([outer, inner], [inner, outer]):
+            self.assertIs(bromine.find_profile(
+                b'abc.T.example.org', profiles), inner)
+            self.assertIs(bromine.find_profile(
+                b'abc.u.example.org', profiles), outer)
+            self.assertIs(bromine.find_profile(
+                b'abct.example.org', profiles), outer)
+
+    def test_mux(self):
+        score_board = bromine.Scoreboard()
+        mux, remote = bromine.Mux(score_board), bromine.Mux(None)
+        bulk, chat = mux.allocate_sid({}), mux.allocate_sid({1: None})
+        self.assertEqual((bulk, chat), (1, 2))
+        size = score_board.capacity() - bromine.OVERHEAD - bromine.MUX_HEADER
+        for sid in (bulk, chat):
+            mux.open(sid)
+        mux.write(bulk, os.urandom(10 * size))
+        mux.write(chat, b'ls\n')
+        mux.close(chat)
+
+        mux.feed(5)  # the OPENs take two lines
+        self.assertFalse(mux.idle())
+        stream = b''.join(bromine.parse_data(line)
+                          for line in score_board.backlog.values())
+        # in pieces, frames straddle them
+        frames = []
+        for i in range(0, len(stream), 7):
+            frames += remote.read(stream[i:i + 7])
+        self.assertEqual([(kind, sid) for kind, sid, _ in frames], [
+            (bromine.MUX_OPEN, bulk), (bromine.MUX_OPEN, chat),
+            (bromine.MUX_DATA, bulk), (bromine.MUX_DATA, chat),
+            (bromine.MUX_CLOSE, chat), (bromine.MUX_DATA, bulk)])
+        self.assertEqual(frames[3][2], b'ls\n')
+        self.assertEqual(len(frames[2][2]), size)
+        self.assertEqual(remote.incoming, b'')
+
+    def test_longpoll(self):
+        profile = bromine.TunnelProfile(longpoll=2, mux=1)
+        client = Endpoint(profile)
+        opening = client.emit.transmit()
+        client.emit.retire(1)
+        client.emit.start_piggyback()
+        self.assertTrue(client.emit.can_poll())
+        polls = client.emit.transmit_batch(3, poll=True)
+        client.recv.add(polls[0])
+        self.assertTrue(client.recv.polled)
+        client.recv.add(client.emit.transmit())
+        self.assertFalse(client.recv.polled)
+
+        replies = []
+
+        def send(reply):
+            replies.append(aio.parse_response(reply, 'cname')[2])
+
+        async def serve():
+            server = aio.Server([profile])
+
+            def query(qid, name):
+                packet = aio.make_query(qid, name, aio.QUERY_TYPES['cname'])
+                server.handle(packet, False, send)
+
+            query(9, opening)
+            for name in replies.pop():
+                client.recv.add(name)
+            for qid, name in enumerate(polls):
+                query(qid, name)
+            # two at most, the oldest goes with our header
+            self.assertEqual(len(replies), 1)
+            (_, socket), = server.sockets.items()
+            self.assertEqual(len(socket.parked), 2)
+            query(7, polls[2])  # the resolver retries
+
+            socket.mux.write(1, b'hello')
+            socket.wake()
+            self.assertEqual(len(replies), 2)
+            for name in replies[1]:
+                client.recv.add(name)
+            frames = bromine.Mux(None).read(b''.join(client.recv.data))
+            self.assertEqual(frames, [(bromine.MUX_DATA, 1, b'hello')])
+
+            for parked in list(socket.parked.values()):
+                parked.release()
+            self.assertEqual(len(replies), 4)
+            self.assertEqual(replies[2], replies[3])
+
+        asyncio.run(serve())
+
+    def test_opens_channel(self):
+        profile = bromine.TunnelProfile(mux=1)
+        fresh = bromine.Scoreboard(profile=profile)
+        fresh.opening = True
+        fresh.push_data(os.urandom(20 * profile.max_size()))
+        names = [fresh.transmit() for _ in range(40)]
+        for name in names:
+            self.assertIn(1, address_to_mids(name, profile))
+            self.assertTrue(bromine.opens_channel(
+                profile.from_address(name), profile))
+
+        # the session of a channel the server reaped
+        reaped = bromine.Scoreboard(profile=profile)
+        reaped.push_data(os.urandom(4 * profile.max_size()))
+        reaped.retire(2)
+        late = reaped.transmit()
+        self.assertNotIn(1, address_to_mids(late, profile))
+        reaped.start_piggyback()
+        acking = reaped.transmit()
+        for name in (late, acking):
+            self.assertFalse(bromine.opens_channel(
+                profile.from_address(name), profile))
+
+        replies = []
+
+        async def serve():
+            server = aio.Server([profile])
+            for qid, name in enumerate([late, acking, names[0]]):
+                packet = aio.make_query(qid, name, aio.QUERY_TYPES['cname'])
+                server.handle(packet, False, replies.append)
+            self.assertEqual([chid for chid, _ in server.sockets.items()],
+                             [fresh.chid])
+
+        asyncio.run(serve())
+        rcodes = [aio.parse_response(reply, 'cname')[1] for reply in replies]
+        self.assertEqual(rcodes, [aio.RCODE_NXDOMAIN] * 2 + [aio.RCODE_OK])
+
+    def test_client_closed(self):
+        queries = []
+
+        class Pump(bromine.ClientPump):
+            stopped = False
+
+            def now(self):
+                return 0.0
+
+            def later(self):
+                pass
+
+            def send_query(self, host, upstream, timeout, sent_at, poll):
+                queries.append((upstream, sent_at, poll))
+
+            def stop(self):
+                self.stopped = True
+
+        pump = Pump([('127.0.0.1', 53)], 'cname')
+        pump.pump()  # idle, one query keeps the downstream open
+        self.assertEqual(len(queries), 1)
+
+        # the connection went, what is in flight still comes back
+        pump.closed = True
+        pump.pump()
+        self.assertFalse(pump.stopped)
+        self.assertEqual(len(queries), 1)
+        pump.received([], *queries[0])
+        pump.pump()
+        self.assertTrue(pump.stopped)
+        self.assertEqual(len(queries), 1)
+
+    def test_replay_edns(self):
+        # a retry gets the answer again, with an OPT record only if it asks
+        profile = bromine.TunnelProfile(mux=1)
+        name = Endpoint(profile).emit.transmit()
+        replies = []
+
+        async def serve():
+            server = aio.Server([profile])
+            for qid, udp_size in enumerate([aio.EDNS_SIZE, None, 4096]):
+                packet = aio.make_query(qid, name, aio.QUERY_TYPES['txt'],
+                                        udp_size)
+                server.handle(packet, False, replies.append)
+            # over tcp the client takes it all in, still without OPT
+            packet = aio.make_query(3, name, aio.QUERY_TYPES['txt'], None)
+            server.handle(packet, True, replies.append)
+            (_, socket), = server.sockets.items()
+            self.assertEqual(socket.replies.hits, 3)
+
+        asyncio.run(serve())
+        values = [aio.parse_response(reply, 'txt')[2] for reply in replies]
+        self.assertEqual(values[0], values[1])
+        self.assertEqual(values[0], values[2])
+        self.assertEqual(values[0], values[3])
+        additional = [struct.unpack_from(aio.HEADER_FORMAT, reply)[5]
+                      for reply in replies]
+        self.assertEqual(additional, [1, 0, 1, 0])
+        self.assertEqual(replies[2][-aio.RR_SIZE:],
+                         struct.pack(aio.RR_FORMAT, aio.TYPE_OPT, 4096, 0, 0))
+
+    def test_tune(self):
+        profile = bromine.TunnelProfile(tune=1, n=5, window=5, ackperiod=4)
+        emit = bromine.Scoreboard(profile=profile)
+        recv = bromine.Systems(profile=profile)
+        emit.push_ack(report=(40, 3, bromine.TUNE_UNKNOWN))
+        recv.add(emit.transmit())
+        self.assertEqual(recv.reports, [(40, 3, bromine.TUNE_UNKNOWN)])
+        line = bromine.make_ack(1, 2, features=bromine.FEATURE_ZLIB)
+        self.assertEqual(bromine.ack_report(line), None)
+
+        # the client measures, the server hears about it
+        client, server = bromine.Tuner(profile), bromine.Tuner(profile)
+        self.assertEqual((client.width, client.window), (5, 5))
+        self.assertEqual(client.report(), bromine.TUNE_UNKNOWN)
+        for _ in range(200):
+            client.sample(False)
+        self.assertEqual(client.width, 1)
+        for i in range(200):
+            client.sample(i % 4 == 0)  # about 13% each way
+        self.assertEqual(client.width, 3)
+        self.assertEqual(client.ackperiod, 3)
+        server.update((0xfff0, 0, client.report()))
+        self.assertEqual((server.width, server.window), (3, 5))
+        # counters wrap, the window grows while decoding keeps up
+        for i in range(30):
+            server.update(((0xfff0 + 16 * i) & 0xffff, 0, client.report()))
+        self.assertEqual(server.window, profile.window * 4)
+        server.update(((0xfff0 + 16 * i + 16) & 0xffff, 8, client.report()))
+        self.assertEqual(server.window, profile.window * 2)
+        # off without TUNE
+        static = bromine.Tuner(bromine.TunnelProfile(n=5))
+        static.sample(True)
+        self.assertEqual(static.width, 5)
+
+        # both ends report and follow them; the client's reports queue
+        # behind its data, it has less to send
+        simulation = bench.Simulation(seed=1, upload=10000, download=20000,
+                                      loss=0.2, profile=profile)
+        self.assertTrue(simulation.run()['complete'])
+        for peer in (simulation.client, simulation.server):
+            self.assertTrue(peer.score_board.tuner.counters['reports'] > 0)
+        self.assertEqual(simulation.client.score_board.tuner.width, 5)
+
+        # names too short for a report, none goes out
+        tiny = bromine.TunnelProfile(tune=1, n=5, _tiny=40)
+        emit = bromine.Scoreboard(profile=tiny)
+        recv = bromine.Systems(profile=tiny)
+        recv.heard = bromine.TUNE_EPOCH
+        emit.tune(recv)
+        self.assertTrue(emit.empty())
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace')
+            trace = bromine.Trace(path)
+            emit, recv = bromine.Scoreboard(), bromine.Systems()
+            payload = data(3)
+            emit.push_data(payload)
+            while recv.received < len(payload):
+                name = emit.transmit()
+                trace.record(bromine.TRACE_NAME_OUT, name)
+                recv.add(name)
+                emit.retire(recv.last_seen_remote_mid)
+            trace.close()
+            result = bench.replay(path)
+            self.assertEqual(result['bytes_out'], len(payload))
+            self.assertEqual(result['streams'], 1)
+
+            # the file moves aside past the limit, once
+            path = os.path.join(directory, 'small')
+            trace = bromine.Trace(path, limit=100)
+            for i in range(3):
+                trace.record(bromine.TRACE_PACKED_IN, bytes([i]) * 40, i)
+            trace.close()
+            self.assertEqual(list(bromine.read_trace(path)),
+                             [(2, bromine.TRACE_PACKED_IN, b'\x02' * 40)])
+            self.assertEqual(len(list(bromine.read_trace(path + '.1'))), 1)
+            with open(path, 'ab') as f:
+                f.write(struct.pack(bromine.TRACE_FORMAT, 3, 1, 40) + b'cut')
+            self.assertEqual(len(list(bromine.read_trace(path))), 1)
+
+    def test_backpressure(self):
+        calls = []
+
+        class Transport:
+            def pause_reading(self):
+                calls.append('pause')
+
+            def resume_reading(self):
+                calls.append('resume')
+
+        channel = aio.Channel(1)
+        channel.connection_made(Transport())
+        size = channel.score_board.capacity() - bromine.OVERHEAD
+        channel.data_received(os.urandom(size * bromine.BACKLOG_LOW))
+        self.assertEqual(calls, [])
+        channel.data_received(os.urandom(size * bromine.BACKLOG_HIGH))
+        self.assertEqual(calls, ['pause'])
+        # the client got most of it, not enough yet
+        board = channel.score_board
+        board.retire(board.profile.successor(board.mid, -bromine.BACKLOG_LOW))
+        channel.throttle()
+        self.assertEqual(calls, ['pause'])
+        board.retire(board.mid)
+        channel.throttle()
+        self.assertEqual(calls, ['pause', 'resume'])
+
+        mux = bromine.Mux(board)
+        mux.write(3, b'x' * 10)
+        mux.write(4, b'y' * 5)
+        self.assertEqual((mux.buffered(3), mux.buffered(5)), (10, 0))
+        self.assertEqual(mux.buffered(), 15)
+
+    def test_sent_history(self):
+        sent = bromine.SentHistory(limit=3)
+        sent.add((1, 2))
+        sent.add((2, 3))
+        sent.add((4,))
+
+        sent.retire(2)
+        self.assertEqual(len(sent), 3)
+        self.assertTrue((1,) in sent)
+        self.assertTrue((3,) in sent)
+        self.assertFalse((1, 2) in sent)
+        self.assertEqual(sent.hit_rate(), 2 / 3)
+
+        # (4,) is the least recently used
+        sent.add((5, 6))
+        self.assertFalse((4,) in sent)
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(set(sent.index), {1, 3, 5, 6})
+
     def test_wrapping_ringbuffer(self):
-        reset = bromine.CONFIG['reset']
         LOOPS = 7
         CLOSER = 23
-        bromine.CONFIG['reset'] = CLOSER
-
-        local, remote = Endpoint(), Endpoint()
+        profile = bromine.TunnelProfile(reset=CLOSER)
+        # mids go 1 to CLOSER - 1, then around
+        self.assertEqual(profile.successor(CLOSER - 1), 1)
+        self.assertEqual(profile.successor(CLOSER - 2, 3), 2)
+        self.assertEqual(profile.offset(CLOSER - 1, 1), 0)
+        self.assertEqual(profile.offset(CLOSER - 3, 2), 3)
+        self.assertEqual(profile.distances(1, CLOSER - 1), (CLOSER - 2, 2))
+        self.assertEqual(profile.compare(1, CLOSER - 1), 1)
+        self.assertEqual(profile.compare(5, 9), -1)
+        self.assertEqual(profile.half, (CLOSER - 1) // 2)
+
+        local, remote = Endpoint(profile), Endpoint(profile)
 
         traffic = []
         # this should wrap a few times
         for _ in range(LOOPS):
             for _ in range(CLOSER // 5):
                 # cant eat more than half the ring space in
-                # one pass, or ring_difference and friends go nuts
+                # one pass, or profile.compare and friends go nuts
                 atom = data(1)
                 local.emit.push_data(atom)
                 traffic.append(atom)
@@ -219,5 +1010,3 @@ class TestCase(unittest.TestCase):
 
         def stitch(a): return b''.join(a)
         self.assertEqual(stitch(traffic), stitch(remote.data))
-
-        bromine.CONFIG['reset'] = reset